@@ -0,0 +1,67 @@
+# -*- encoding: utf-8 -*-
+import os
+import sys
+import tempfile
+import time
+
+from log_parse import parse
+
+
+def make_log(path, size):
+    # the sample log repeated with distinct ids in urls up to the given size
+    with open('log.log', 'rb') as log_file:
+        lines = log_file.readlines()
+    written = 0
+    copy = 0
+    with open(path, 'wb') as big_log:
+        while written < size:
+            block = b''.join(line.replace(b'/40', '/{}'.format(copy).encode()) for line in lines)
+            big_log.write(block)
+            written += len(block)
+            copy += 1
+
+
+def bench_filters(path, counts):
+    # ignored urls that never match make every line check all of them
+    with open(path, 'rb') as log_file:
+        lines = sum(1 for _ in log_file)
+    for count in counts:
+        ignore_urls = ['/ignored/{}'.format(number) for number in range(count)]
+        started = time.time()
+        result = parse(files=[path], ignore_urls=ignore_urls, ignore_www=True)
+        elapsed = time.time() - started
+        print("{:8} ignored urls {:7.2f} s {:8.2f} us/line  {}".format(
+            count, elapsed, elapsed / lines * 10 ** 6, result))
+
+
+def main(argv):
+    options = {'size': str(1024 ** 3), 'processes': ','.join(
+        str(processes) for processes in (1, 2, 4, 8, 16) if processes <= os.cpu_count()),
+        'ignore-urls': ''}
+    for arg in argv:
+        name, _, value = arg.lstrip('-').partition('=')
+        if name not in options:
+            print("Usage: python3 bench.py [--size=BYTES] [--processes=1,2,4] "
+                  "[--ignore-urls=0,100,10000]")
+            return
+        options[name] = value
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'big.log')
+        make_log(path, int(options['size']))
+        size = os.path.getsize(path)
+        if options['ignore-urls']:
+            bench_filters(path, map(int, options['ignore-urls'].split(',')))
+            return
+        first_time = None
+        for processes in map(int, options['processes'].split(',')):
+            started = time.time()
+            result = parse(files=[path], processes=processes)
+            elapsed = time.time() - started
+            first_time = first_time or elapsed
+            print("{:3} processes {:7.2f} s {:8.1f} MB/s  x{:.2f}  {}".format(
+                processes, elapsed, size / elapsed / 2 ** 20, first_time / elapsed, result))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
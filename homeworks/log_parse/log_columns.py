@@ -0,0 +1,141 @@
+# -*- encoding: utf-8 -*-
+import array
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from log_parse import EPOCH, fast_params_from_line, read_lines
+
+# response times that aren't integers, parse counts such requests but not their time
+NO_TIME = -2 ** 63
+
+
+def export_columns(sources, directory):
+    # requests of the logs become columns: epoch seconds, url ids, request
+    # type ids and response times, urls and types are listed in text files
+    if numpy is None:
+        raise ImportError('numpy is required for columnar export')
+    url_ids = dict()
+    type_ids = dict()
+    dates = array.array('q')
+    urls = array.array('i')
+    types = array.array('H')
+    times = array.array('q')
+    for line in read_lines(sources):
+        parsed_params = fast_params_from_line(line)
+        if not parsed_params:
+            continue
+        request_date, request_type, url, response_time = parsed_params
+        dates.append(int((request_date - EPOCH).total_seconds()))
+        urls.append(url_ids.setdefault(url, len(url_ids)))
+        types.append(type_ids.setdefault(request_type, len(type_ids)))
+        try:
+            times.append(int(response_time))
+        except (ValueError, OverflowError):
+            times.append(NO_TIME)
+
+    os.makedirs(directory, exist_ok=True)
+    numpy.save(os.path.join(directory, 'dates.npy'), numpy.frombuffer(dates, numpy.int64))
+    numpy.save(os.path.join(directory, 'urls.npy'), numpy.frombuffer(urls, numpy.int32))
+    numpy.save(os.path.join(directory, 'types.npy'), numpy.frombuffer(types, numpy.uint16))
+    numpy.save(os.path.join(directory, 'times.npy'), numpy.frombuffer(times, numpy.int64))
+    # urls and types have no whitespace, one per line
+    with open(os.path.join(directory, 'urls.txt'), 'w', encoding='utf-8') as urls_file:
+        urls_file.writelines(url + '\n' for url in url_ids)
+    with open(os.path.join(directory, 'types.txt'), 'w', encoding='utf-8') as types_file:
+        types_file.writelines(request_type + '\n' for request_type in type_ids)
+
+
+class LogColumns:
+    # queries with the options of parse() over exported columns, the
+    # columns are memory mapped and every option is a vectorized operation
+    def __init__(self, directory):
+        if numpy is None:
+            raise ImportError('numpy is required for columnar queries')
+        self.dates = numpy.load(os.path.join(directory, 'dates.npy'), mmap_mode='r')
+        self.urls = numpy.load(os.path.join(directory, 'urls.npy'), mmap_mode='r')
+        self.types = numpy.load(os.path.join(directory, 'types.npy'), mmap_mode='r')
+        self.times = numpy.load(os.path.join(directory, 'times.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'urls.txt'), encoding='utf-8') as urls_file:
+            self.url_names = urls_file.read().split('\n')[:-1]
+        with open(os.path.join(directory, 'types.txt'), encoding='utf-8') as types_file:
+            self.type_names = types_file.read().split('\n')[:-1]
+
+    def top_urls(self, **options):
+        urls, times = self.select(**options)
+        return self._top(numpy.bincount(urls))
+
+    def slow_queries(self, **options):
+        urls, times = self.select(**options)
+        if not len(urls):
+            return []
+        counts = numpy.bincount(urls)
+        timed = times != NO_TIME
+        total_times = numpy.zeros(len(counts), numpy.int64)
+        numpy.add.at(total_times, urls[timed], times[timed])
+        has_time = numpy.bincount(urls[timed], minlength=len(counts)) > 0
+        return self._top(numpy.where(has_time, total_times // numpy.maximum(counts, 1), 0),
+                         has_time)
+
+    def select(
+        self,
+        ignore_files=False,
+        ignore_urls=[],
+        start_at=None,
+        stop_at=None,
+        request_type=None,
+        ignore_www=False
+    ):
+        # the same filters in the same order as parse(): rows skipped by
+        # start_at, request_type and ignore_files can't stop the reading
+        skipped = numpy.zeros(len(self.dates), bool)
+        if start_at:
+            skipped |= self.dates < (start_at - EPOCH).total_seconds()
+        if request_type:
+            if request_type in self.type_names:
+                skipped |= self.types != self.type_names.index(request_type)
+            else:
+                skipped[:] = True
+        if ignore_files:
+            is_file = numpy.array([
+                '.' in url[url.rfind('/') + 1:] for url in self.url_names], bool)
+            skipped |= is_file[self.urls]
+        if stop_at:
+            stops = ~skipped & (self.dates > (stop_at - EPOCH).total_seconds())
+            if stops.any():
+                end = int(stops.argmax())
+                skipped = skipped[:end]
+
+        rows = numpy.flatnonzero(~skipped)
+        urls = numpy.asarray(self.urls[rows])
+        times = numpy.asarray(self.times[rows])
+
+        # ignored urls and www are decided once per distinct url
+        ignored_urls = set(ignore_urls)
+        names = dict()
+        url_map = numpy.empty(len(self.url_names), numpy.int64)
+        for url_id, url in enumerate(self.url_names):
+            if ignore_www and url[:3] == "www":
+                if url in ignored_urls or url[4:] in ignored_urls:
+                    url_map[url_id] = -1
+                    continue
+                url = url[4:]
+            elif url in ignored_urls:
+                url_map[url_id] = -1
+                continue
+            url_map[url_id] = names.setdefault(url, len(names))
+        urls = url_map[urls]
+        kept = urls >= 0
+        return urls[kept], times[kept]
+
+    def _top(self, values, present=None):
+        # the 5 largest values among urls that were requested
+        if present is None:
+            present = values > 0
+        values = values[present]
+        if len(values) > 5:
+            values = numpy.partition(values, len(values) - 5)[-5:]
+        return sorted(values.tolist(), reverse=True)
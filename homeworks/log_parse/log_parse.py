@@ -1,5 +1,45 @@
 # -*- encoding: utf-8 -*-
+import array
+import bisect
 import datetime
+import functools
+import gzip
+import heapq
+import io
+import itertools
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import struct
+import zlib
+
+READ_BUFFER_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024 * 1024
+# the usual layout: [dd/Mon/YYYY HH:MM:SS] "TYPE URL PROTOCOL" code time,
+# fields can't contain quotes because the strict parser splits by them
+LINE_PATTERN = re.compile(r'\[([0-9]{2})/([A-Z][a-z]{2})/([0-9]{4}) ([0-9]{2}):([0-9]{2}):([0-9]{2})\]'
+                          r'\s*"\s*([^\s"]+)\s+([^\s"]+)[^"]*"\s*[^\s"]+\s+([^\s"]+)')
+MONTHS = {month: number for number, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+DATES_CACHE_SIZE = 4096
+INDEX_STEP = 1024 * 1024
+INDEX_HEAD_SIZE = 4096
+# inode, length and checksum of the head of the log, indexed length,
+# latest date so far, number of checkpoints
+INDEX_HEADER = struct.Struct('>QIIQqI')
+INDEX_CHECKPOINT = struct.Struct('>Qq')
+# size, mtime and checksum of the head and the tail of the log, number of
+# requests, urls, request types and response times that aren't plain numbers
+CACHE_HEADER = struct.Struct('>QqIIIII4x')
+CACHE_SAMPLE_SIZE = 64 * 1024
+EPOCH = datetime.datetime(1970, 1, 1)
+NO_DATE = -2 ** 62
+
+# lines of one second come together, their dates are parsed once
+_dates_cache = dict()
 
 
 def get_params_from_line(line):
@@ -20,30 +60,54 @@ def get_params_from_line(line):
     except IndexError:
         return None
 
-    protocol_in_url = request[:request.find(':')]
-    request = request[len(protocol_in_url) + len(":"):]
+    return request_date, _request_type, normalize_url(request), response_time
+
+
+def fast_params_from_line(line):
+    # the same result as get_params_from_line, lines of other layouts and
+    # impossible dates go to get_params_from_line
+    match = LINE_PATTERN.match(line)
+    if match is None:
+        return get_params_from_line(line)
+    request_date = _dates_cache.get(match.group(1, 2, 3, 4, 5, 6))
+    if request_date is None:
+        day, month, year, hour, minute, second = match.group(1, 2, 3, 4, 5, 6)
+        if month not in MONTHS:
+            return get_params_from_line(line)
+        try:
+            request_date = datetime.datetime(int(year), MONTHS[month], int(day),
+                                             int(hour), int(minute), int(second))
+        except ValueError:
+            return get_params_from_line(line)
+        if len(_dates_cache) >= DATES_CACHE_SIZE:
+            _dates_cache.clear()
+        _dates_cache[match.group(1, 2, 3, 4, 5, 6)] = request_date
+    return request_date, match.group(7), normalize_url(match.group(8)), match.group(9)
+
+
+def normalize_url(request):
+    # scheme, login, password, port, parameters and anchor are dropped;
+    # a request without a scheme gives an empty url
+    colon_position = request.find(':')
+    request = request[colon_position + 1:] if colon_position != -1 else ''
     if request[:2] == "//":
         request = request[2:]
-    if request.find('@') != -1:
-        request = request[request.find('@') + 1:]
-    
+    at_position = request.find('@')
+    if at_position != -1:
+        request = request[at_position + 1:]
+
     colon_position = request.find(':')
     if colon_position != -1:
-        if request.find('/') != -1:
-            request = request[:colon_position] + request[request.find('/'):]
+        slash_position = request.find('/')
+        if slash_position != -1:
+            request = request[:colon_position] + request[slash_position:]
         else:
             request = request[:colon_position]
 
-    question_mark_position = request.find('?')
-    grating_mark_position = request.find('#')
-    if question_mark_position != -1:
-        url = request[:question_mark_position]
-    elif grating_mark_position != -1:
-        url = request[:grating_mark_position]
-    else:
-        url = request
-        
-    return request_date, _request_type, url, response_time
+    end_position = request.find('?')
+    if end_position == -1:
+        end_position = request.find('#')
+    return request[:end_position] if end_position != -1 else request
 
 
 def parse(
@@ -53,53 +117,708 @@ def parse(
     stop_at=None,
     request_type=None,
     ignore_www=False,
-    slow_queries=False
+    slow_queries=False,
+    files=None,
+    processes=1,
+    time_index=False,
+    checkpoint=None,
+    max_error=None,
+    percentile=None,
+    cache=False
 ):
-    urls = dict()
-    response_times = dict()
+    if slow_queries and percentile:
+        aggregator = LatencyPercentiles(percentile)
+    elif slow_queries:
+        aggregator = SlowQueries()
+    elif max_error:
+        aggregator = ApproximateTopUrls(max_error)
+    else:
+        aggregator = TopUrls()
+    options = dict(ignore_files=ignore_files, ignore_urls=ignore_urls, start_at=start_at,
+                   stop_at=stop_at, request_type=request_type, ignore_www=ignore_www)
     try:
-        with open("log.log", "r") as log_file:
-            for line in log_file:
-                parsed_params = get_params_from_line(line)
-                if parsed_params:
-                    request_date, _request_type, url, response_time = parsed_params
-                else:
-                    continue
-                if (start_at and request_date < start_at) or \
-                    (request_type and _request_type != request_type) or \
-                    (ignore_files and '.' in url[url.rfind('/') + 1:]):
-                    continue
-                if stop_at and request_date > stop_at:
-                    break
-                if ignore_www and url[:3] == "www":
-                    if url in ignore_urls or url[4:] in ignore_urls:
-                        continue
-                    url = url[4:]
-                elif url in ignore_urls:
-                    continue
-
-                urls[url] = urls[url] + 1 if url in urls else 1
-                if slow_queries:
-                    try:
-                        if url in response_times:
-                            response_times[url] += int(response_time)
-                        else:
-                            response_times[url] = int(response_time)
-                    except ValueError:
-                        continue
-
-        if slow_queries:
-            for url in urls:
-                response_times[url] //= int(urls[url])
-
-        return get_results((urls, response_times)[slow_queries])
-
+        if checkpoint:
+            paths = files or ["log.log"]
+            if len(paths) != 1:
+                raise ValueError('follow mode takes exactly one file, got {}'.format(len(paths)))
+            path, = paths
+            return Follower(path, [aggregator], checkpoint, **options).poll()[0]
+        options['time_index'] = time_index
+        # only paths can be cut into chunks
+        if processes > 1 and not cache and all(isinstance(source, str) for source in files or []):
+            analyze_parallel(files or ["log.log"], [aggregator], processes, **options)
+        else:
+            analyze(files or ["log.log"], [aggregator], cache=cache, **options)
     except IOError:
         return []
 
+    return aggregator.result()
+
+
+def analyze(
+    sources,
+    aggregators,
+    ignore_files=False,
+    ignore_urls=[],
+    start_at=None,
+    stop_at=None,
+    request_type=None,
+    ignore_www=False,
+    time_index=False,
+    line_filter=None,
+    cache=False
+):
+    # one pass over all sources feeds every aggregator, the sources are
+    # read as one log, so stop_at ends the whole pass. A ready line_filter
+    # replaces the options, with cache the requests of paths are taken
+    # from their parse caches
+    if line_filter is None:
+        line_filter = LineFilter(ignore_files, ignore_urls, start_at, stop_at, request_type,
+                                 ignore_www)
+    if cache:
+        feed_params(itertools.chain.from_iterable(
+            ParseCache(source).params() if isinstance(source, str)
+            else map(fast_params_from_line, read_lines([source])) for source in sources
+        ), aggregators, line_filter)
+    else:
+        feed(read_lines(sources, line_filter.start_at if time_index else None), aggregators,
+             line_filter)
+    return [aggregator.result() for aggregator in aggregators]
+
+
+def analyze_parallel(paths, aggregators, processes=None, chunk_size=CHUNK_SIZE,
+                     time_index=False, line_filter=None, **options):
+    # files are cut at line boundaries into chunks parsed by a pool of
+    # processes, partial results are merged in the order of the chunks up to
+    # the chunk where stop_at was passed, so the result is the same as of analyze
+    if line_filter is None:
+        line_filter = LineFilter(**options)
+    chunks = list(split_chunks(paths, chunk_size,
+                               line_filter.start_at if time_index else None))
+    task = functools.partial(analyze_chunk, aggregators=[aggregator.empty_copy()
+                                                         for aggregator in aggregators],
+                             line_filter=line_filter)
+    with multiprocessing.Pool(processes) as pool:
+        for partials, stopped in pool.imap(task, chunks):
+            for aggregator, partial in zip(aggregators, partials):
+                aggregator.merge(partial)
+            if stopped:
+                break
+    return [aggregator.result() for aggregator in aggregators]
+
+
+def analyze_chunk(chunk, aggregators, line_filter):
+    stopped = feed(read_chunk(*chunk), aggregators, line_filter)
+    return aggregators, stopped
+
+
+class LineFilter:
+    # the options of parse() prepared once for any number of files and
+    # calls: ignored urls are a set, so a line costs the same for any
+    # number of them, and the cheapest checks go first
+    def __init__(
+        self,
+        ignore_files=False,
+        ignore_urls=[],
+        start_at=None,
+        stop_at=None,
+        request_type=None,
+        ignore_www=False
+    ):
+        self.ignore_files = ignore_files
+        self.ignore_urls = frozenset(ignore_urls)
+        self.start_at = start_at
+        self.stop_at = stop_at
+        self.request_type = request_type
+        self.ignore_www = ignore_www
+
+
+def feed(lines, aggregators, line_filter):
+    # returns True if the lines ended at stop_at
+    return feed_params(map(fast_params_from_line, lines), aggregators, line_filter)
+
+
+def feed_params(params, aggregators, line_filter):
+    # the same for requests already taken from lines
+    ignore_files = line_filter.ignore_files
+    ignore_urls = line_filter.ignore_urls
+    start_at = line_filter.start_at
+    stop_at = line_filter.stop_at
+    request_type = line_filter.request_type
+    ignore_www = line_filter.ignore_www
+    for parsed_params in params:
+        if parsed_params:
+            request_date, _request_type, url, response_time = parsed_params
+        else:
+            continue
+        # lines skipped here can't stop the reading
+        if (request_type and _request_type != request_type) or \
+            (start_at and request_date < start_at) or \
+            (ignore_files and '.' in url[url.rfind('/') + 1:]):
+            continue
+        if stop_at and request_date > stop_at:
+            return True
+        if ignore_www and url[:3] == "www":
+            if url in ignore_urls or url[4:] in ignore_urls:
+                continue
+            url = url[4:]
+        elif ignore_urls and url in ignore_urls:
+            continue
+
+        for aggregator in aggregators:
+            aggregator.add(request_date, _request_type, url, response_time)
+
+    return False
+
+
+def read_lines(sources, start_at=None):
+    # sources are paths, .gz paths or opened files in text or binary mode;
+    # with start_at plain files are read from the place given by their time index
+    for source in sources:
+        if isinstance(source, str):
+            offset = 0
+            if start_at and not source.endswith('.gz'):
+                offset = TimeIndex(source).seek_offset(start_at)
+            log_file = open_log(source, offset)
+        elif isinstance(source, io.TextIOBase):
+            log_file = source
+        else:
+            log_file = io.TextIOWrapper(source, encoding='utf-8', errors='replace')
+        try:
+            for line in log_file:
+                yield line
+        finally:
+            if isinstance(source, str):
+                log_file.close()
+            elif log_file is not source:
+                # the wrapper would close the file of the caller when collected
+                log_file.detach()
+
+
+def split_chunks(paths, chunk_size, start_at=None):
+    # a chunk holds the lines that start inside it, gzip files can't be cut
+    for path in paths:
+        if not isinstance(path, str):
+            raise TypeError('parallel parsing takes paths, not opened files')
+        if path.endswith('.gz'):
+            yield path, 0, None
+            continue
+        size = os.path.getsize(path)
+        first = TimeIndex(path).seek_offset(start_at) if start_at else 0
+        for start in range(first, size, chunk_size):
+            yield path, start, min(start + chunk_size, size)
+
+
+def read_chunk(path, start, end):
+    if end is None:
+        yield from read_lines([path])
+        return
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as log_file:
+        if start:
+            log_file.seek(start - 1)
+            start += len(log_file.readline()) - 1
+        position = start
+        for line in log_file:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8', 'replace')
+
+
+def open_log(path, offset=0):
+    if path.endswith('.gz'):
+        raw_file = io.BufferedReader(gzip.open(path), READ_BUFFER_SIZE)
+    else:
+        raw_file = open(path, 'rb', buffering=READ_BUFFER_SIZE)
+        raw_file.seek(offset)
+    return io.TextIOWrapper(raw_file, encoding='utf-8', errors='replace')
+
+
+class TimeIndex:
+    # sidecar file <log>.idx with checkpoints every `step` bytes: the offset
+    # of a line and the latest date of all lines before it. Dates in a log
+    # aren't sorted, but every line before a checkpoint whose latest date is
+    # earlier than start_at is skipped by parse anyway, so reading may start
+    # there. The index is extended when the log grows and rebuilt when the
+    # log is replaced
+    def __init__(self, path, step=INDEX_STEP):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.step = step
+        self._reset()
+
+    def _reset(self):
+        self.offsets = [0]
+        self.max_dates = [NO_DATE]
+        self.indexed = 0
+        self.max_date = NO_DATE
+        self._head = (0, 0)
+
+    def seek_offset(self, start_at):
+        self.update()
+        offsets = self.offsets + [self.indexed]
+        max_dates = self.max_dates + [self.max_date]
+        start_at = (start_at - EPOCH).total_seconds()
+        return offsets[bisect.bisect_left(max_dates, start_at) - 1]
+
+    def update(self):
+        with open(self.path, 'rb') as log_file:
+            stat = os.fstat(log_file.fileno())
+            self._load()
+            head = log_file.read(INDEX_HEAD_SIZE)
+            if self._inode != stat.st_ino or self.indexed > stat.st_size or \
+                    zlib.crc32(head[:self._head[0]]) != self._head[1]:
+                self._reset()
+            if self._head[0] < len(head):
+                self._head = (len(head), zlib.crc32(head))
+            self._inode = stat.st_ino
+            if self.indexed == stat.st_size:
+                return
+            log_file.seek(self.indexed)
+            self._index_lines(log_file)
+        try:
+            self._save()
+        except IOError:
+            pass
+
+    def _index_lines(self, log_file):
+        position = self.indexed
+        next_checkpoint = self.offsets[-1] + self.step
+        for line in log_file:
+            if not line.endswith(b'\n'):
+                # the last line is still being written
+                break
+            if position >= next_checkpoint:
+                self.offsets.append(position)
+                self.max_dates.append(self.max_date)
+                next_checkpoint = position + self.step
+            parsed_params = fast_params_from_line(line.decode('utf-8', 'replace'))
+            if parsed_params:
+                self.max_date = max(self.max_date, int((parsed_params[0] - EPOCH).total_seconds()))
+            position += len(line)
+        self.indexed = position
+
+    def _load(self):
+        self._inode = None
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                data = index_file.read()
+        except IOError:
+            return
+        if len(data) < INDEX_HEADER.size:
+            return
+        inode, head_length, head_crc, indexed, max_date, count = INDEX_HEADER.unpack_from(data)
+        if len(data) != INDEX_HEADER.size + count * INDEX_CHECKPOINT.size:
+            return
+        checkpoints = list(INDEX_CHECKPOINT.iter_unpack(data[INDEX_HEADER.size:]))
+        self.offsets = [offset for offset, checkpoint_date in checkpoints]
+        self.max_dates = [checkpoint_date for offset, checkpoint_date in checkpoints]
+        self.indexed = indexed
+        self.max_date = max_date
+        self._head = (head_length, head_crc)
+        self._inode = inode
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(INDEX_HEADER.pack(self._inode, self._head[0], self._head[1],
+                                               self.indexed, self.max_date, len(self.offsets)))
+            index_file.write(b''.join(INDEX_CHECKPOINT.pack(offset, checkpoint_date)
+                                      for offset, checkpoint_date
+                                      in zip(self.offsets, self.max_dates)))
+        os.replace(tmp_path, self.index_path)
+
+
+class ParseCache:
+    # sidecar file <log>.cache with the requests of the log in columns:
+    # dates in seconds, numbers of urls and request types, response times.
+    # It is used while size, mtime and the head and tail of the log are
+    # the same, otherwise the log is parsed again
+    def __init__(self, path):
+        self.path = path
+        self.cache_path = path + '.cache'
+
+    def params(self):
+        key = self._key()
+        try:
+            cache_file = open(self.cache_path, 'rb')
+        except IOError:
+            cache_file = None
+        if cache_file is not None:
+            with cache_file:
+                data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if os.fstat(cache_file.fileno()).st_size else b''
+                if len(data) >= CACHE_HEADER.size and \
+                        CACHE_HEADER.unpack_from(data)[:3] == key:
+                    yield from self._read(data)
+                    return
+        data = self._build(key)
+        # a log changed while it was read isn't cached
+        if self._key() == key:
+            try:
+                self._save(data)
+            except IOError:
+                pass
+        yield from self._read(data)
+
+    def _key(self):
+        with open(self.path, 'rb') as log_file:
+            stat = os.fstat(log_file.fileno())
+            checksum = zlib.crc32(log_file.read(CACHE_SAMPLE_SIZE))
+            if stat.st_size > CACHE_SAMPLE_SIZE:
+                log_file.seek(max(CACHE_SAMPLE_SIZE, stat.st_size - CACHE_SAMPLE_SIZE))
+                checksum = zlib.crc32(log_file.read(CACHE_SAMPLE_SIZE), checksum)
+        return stat.st_size, stat.st_mtime_ns, checksum
+
+    def _read(self, data):
+        size, mtime, checksum, rows, url_count, type_count, odd_count = \
+            CACHE_HEADER.unpack_from(data)
+        columns = memoryview(data)[CACHE_HEADER.size:]
+        dates = columns[:rows * 8].cast('q')
+        times = columns[rows * 8:rows * 16].cast('q')
+        urls = columns[rows * 16:rows * 20].cast('i')
+        types = columns[rows * 20:rows * 24].cast('i')
+        names = bytes(columns[rows * 24:]).decode('utf-8').split('\n')
+        url_names = names[:url_count]
+        type_names = names[url_count:url_count + type_count]
+        odd_times = names[url_count + type_count:url_count + type_count + odd_count]
+        dates_cache = dict()
+        for date, response_time, url, request_type in zip(dates, times, urls, types):
+            request_date = dates_cache.get(date)
+            if request_date is None:
+                if len(dates_cache) >= DATES_CACHE_SIZE:
+                    dates_cache.clear()
+                request_date = dates_cache[date] = EPOCH + datetime.timedelta(seconds=date)
+            yield request_date, type_names[request_type], url_names[url], \
+                str(response_time) if response_time >= 0 else odd_times[-response_time - 1]
+
+    def _build(self, key):
+        # response times that don't come back the same from int() are kept as text
+        url_ids = dict()
+        type_ids = dict()
+        odd_times = dict()
+        dates = array.array('q')
+        times = array.array('q')
+        urls = array.array('i')
+        types = array.array('i')
+        for line in read_lines([self.path]):
+            parsed_params = fast_params_from_line(line)
+            if not parsed_params:
+                continue
+            request_date, request_type, url, response_time = parsed_params
+            dates.append(int((request_date - EPOCH).total_seconds()))
+            urls.append(url_ids.setdefault(url, len(url_ids)))
+            types.append(type_ids.setdefault(request_type, len(type_ids)))
+            try:
+                number = int(response_time)
+            except ValueError:
+                number = -1
+            if 0 <= number < 2 ** 63 and str(number) == response_time:
+                times.append(number)
+            else:
+                times.append(-odd_times.setdefault(response_time, len(odd_times)) - 1)
+        names = '\n'.join(itertools.chain(url_ids, type_ids, odd_times)).encode('utf-8')
+        return b''.join([CACHE_HEADER.pack(*key, len(dates), len(url_ids), len(type_ids),
+                                           len(odd_times)),
+                         dates.tobytes(), times.tobytes(), urls.tobytes(), types.tobytes(), names])
+
+    def _save(self, data):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+
+class Follower:
+    # parses only the lines appended to a log since the previous poll, the
+    # position in the log and the aggregates are kept in a checkpoint file.
+    # A log rotated to <log>.1 is read to its end before the new log
+    def __init__(self, path, aggregators, checkpoint_path, **options):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.options = options
+        self.line_filter = LineFilter(**options)
+        self.aggregators = aggregators
+        self.inode = None
+        self.offset = 0
+        self.stopped = False
+        self._load()
+
+    def poll(self):
+        if not self.stopped:
+            try:
+                log_file = open(self.path, 'rb')
+            except IOError:
+                log_file = None
+            inode = log_file and os.fstat(log_file.fileno()).st_ino
+            if self.inode is not None and inode != self.inode:
+                self._read_rotated()
+                self.offset = 0
+                self.inode = inode
+            if log_file is not None:
+                with log_file:
+                    if os.fstat(log_file.fileno()).st_size < self.offset:
+                        # truncated in place
+                        self.offset = 0
+                    self.inode = inode
+                    self._read(log_file)
+            self._save()
+        return [aggregator.result() for aggregator in self.aggregators]
+
+    def _read_rotated(self):
+        try:
+            with open(self.path + '.1', 'rb') as rotated_file:
+                if os.fstat(rotated_file.fileno()).st_ino == self.inode:
+                    self._read(rotated_file)
+        except IOError:
+            pass
+
+    def _read(self, log_file):
+        if self.stopped:
+            return
+        log_file.seek(self.offset)
+        self.stopped = feed(self._new_lines(log_file), self.aggregators, self.line_filter)
+
+    def _new_lines(self, log_file):
+        for line in log_file:
+            if not line.endswith(b'\n'):
+                # the last line is still being written
+                break
+            self.offset += len(line)
+            yield line.decode('utf-8', 'replace')
+
+    def _load(self):
+        try:
+            with open(self.checkpoint_path, 'rb') as checkpoint_file:
+                state = pickle.load(checkpoint_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
+        # a checkpoint of another log or query is ignored
+        if state['path'] != self.path or state['options'] != self.options or \
+                [type(aggregator) for aggregator in state['aggregators']] != \
+                [type(aggregator) for aggregator in self.aggregators]:
+            return
+        self.aggregators = state['aggregators']
+        self.inode = state['inode']
+        self.offset = state['offset']
+        self.stopped = state['stopped']
+
+    def _save(self):
+        state = {'path': self.path, 'options': self.options, 'aggregators': self.aggregators,
+                 'inode': self.inode, 'offset': self.offset, 'stopped': self.stopped}
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as checkpoint_file:
+            pickle.dump(state, checkpoint_file)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+class TopUrls:
+    def __init__(self):
+        self.urls = dict()
+
+    def add(self, request_date, request_type, url, response_time):
+        self.urls[url] = self.urls[url] + 1 if url in self.urls else 1
+
+    def empty_copy(self):
+        return TopUrls()
+
+    def merge(self, other):
+        merge_counts(self.urls, other.urls)
+
+    def result(self):
+        return get_results(self.urls)
+
+
+class ApproximateTopUrls:
+    # Space-Saving: at most 1 / max_error urls are counted, a new url takes
+    # the place of the least counted one and its count plus one, so every
+    # count is at most max_error * <number of requests> above the real one.
+    # The heap of counts may lag behind the counts and is fixed when the
+    # least counted url is needed
+    def __init__(self, max_error=0.0001):
+        self.max_error = max_error
+        self.capacity = int(math.ceil(1 / max_error))
+        self.urls = dict()
+        self.total = 0
+        self._heap = []
+
+    def add(self, request_date, request_type, url, response_time):
+        self.total += 1
+        if url in self.urls:
+            self.urls[url] += 1
+        elif len(self.urls) < self.capacity:
+            self.urls[url] = 1
+            heapq.heappush(self._heap, (1, url))
+        else:
+            count = self._pop_least() + 1
+            self.urls[url] = count
+            heapq.heappush(self._heap, (count, url))
+
+    def _pop_least(self):
+        while True:
+            count, url = heapq.heappop(self._heap)
+            if self.urls[url] == count:
+                del self.urls[url]
+                return count
+            heapq.heappush(self._heap, (self.urls[url], url))
+
+    def error_bound(self):
+        return self.total // self.capacity
+
+    def empty_copy(self):
+        return ApproximateTopUrls(self.max_error)
+
+    def merge(self, other):
+        # a url missing from a full summary could have been counted up to its minimum
+        least = min(self.urls.values()) if len(self.urls) >= self.capacity else 0
+        other_least = min(other.urls.values()) if len(other.urls) >= other.capacity else 0
+        merged = {url: self.urls.get(url, least) + other.urls.get(url, other_least)
+                  for url in set(self.urls) | set(other.urls)}
+        self.urls = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda x: x[1]))
+        self.total += other.total
+        self._heap = [(count, url) for url, count in self.urls.items()]
+        heapq.heapify(self._heap)
+
+    def result(self):
+        return get_results(self.urls)
+
+
+class SlowQueries:
+    def __init__(self):
+        self.urls = dict()
+        self.response_times = dict()
+
+    def add(self, request_date, request_type, url, response_time):
+        self.urls[url] = self.urls[url] + 1 if url in self.urls else 1
+        try:
+            if url in self.response_times:
+                self.response_times[url] += int(response_time)
+            else:
+                self.response_times[url] = int(response_time)
+        except ValueError:
+            pass
+
+    def empty_copy(self):
+        return SlowQueries()
+
+    def merge(self, other):
+        merge_counts(self.urls, other.urls)
+        merge_counts(self.response_times, other.response_times)
+
+    def result(self):
+        return get_results({url: self.response_times[url] // self.urls[url] for url in self.urls})
+
+
+class LatencySketch:
+    # response times in buckets growing by `gamma` times, so any quantile is
+    # found with the given relative error; the lowest buckets are joined if
+    # there are more than max_buckets of them
+    __slots__ = ('buckets', 'zeros', 'count')
+
+    def __init__(self):
+        self.buckets = dict()
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value, log_gamma, max_buckets):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        bucket = int(math.ceil(math.log(value) / log_gamma))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        if len(self.buckets) > max_buckets:
+            self._collapse(max_buckets)
+
+    def merge(self, other, max_buckets):
+        self.count += other.count
+        self.zeros += other.zeros
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        if len(self.buckets) > max_buckets:
+            self._collapse(max_buckets)
+
+    def _collapse(self, max_buckets):
+        lowest = sorted(self.buckets)[:len(self.buckets) - max_buckets + 1]
+        self.buckets[lowest[-1]] += sum(self.buckets.pop(bucket) for bucket in lowest[:-1])
+
+    def quantile(self, q, gamma):
+        rank = int(q / 100 * (self.count - 1))
+        if rank < self.zeros:
+            return 0
+        seen = self.zeros
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return int(round(2 * gamma ** bucket / (gamma + 1)))
+        return 0
+
+
+class LatencyPercentiles:
+    # per url sketches of response times: p50, p95 and p99 with
+    # relative_error in fixed memory per url, sketches of several
+    # files or processes are merged without loss
+    def __init__(self, percentile=99, relative_error=0.01, max_buckets=2048):
+        self.percentile = percentile
+        self.relative_error = relative_error
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self.gamma)
+        self.sketches = dict()
+
+    def add(self, request_date, request_type, url, response_time):
+        try:
+            response_time = int(response_time)
+        except ValueError:
+            return
+        sketch = self.sketches.get(url)
+        if sketch is None:
+            sketch = self.sketches[url] = LatencySketch()
+        sketch.add(response_time, self._log_gamma, self.max_buckets)
+
+    def empty_copy(self):
+        return LatencyPercentiles(self.percentile, self.relative_error, self.max_buckets)
+
+    def merge(self, other):
+        for url, other_sketch in other.sketches.items():
+            sketch = self.sketches.get(url)
+            if sketch is None:
+                sketch = self.sketches[url] = LatencySketch()
+            sketch.merge(other_sketch, self.max_buckets)
+
+    def report(self, percentiles=(50, 95, 99)):
+        return {url: tuple(sketch.quantile(q, self.gamma) for q in percentiles)
+                for url, sketch in self.sketches.items()}
+
+    def result(self):
+        return get_results({url: sketch.quantile(self.percentile, self.gamma)
+                            for url, sketch in self.sketches.items()})
+
+
+class RequestTypes:
+    def __init__(self):
+        self.types = dict()
+
+    def add(self, request_date, request_type, url, response_time):
+        self.types[request_type] = self.types[request_type] + 1 if request_type in self.types else 1
+
+    def empty_copy(self):
+        return RequestTypes()
+
+    def merge(self, other):
+        merge_counts(self.types, other.types)
+
+    def result(self):
+        return self.types
+
+
+def merge_counts(counts, other_counts):
+    for key, value in other_counts.items():
+        counts[key] = counts[key] + value if key in counts else value
+
 
 def get_results(results_dict):
-    top_urls = sorted(results_dict.items(), key=lambda x: x[1], reverse=True)[:5]
+    top_urls = heapq.nlargest(5, results_dict.items(), key=lambda x: x[1])
     result = [top_url[1] for top_url in top_urls]
 
     return result
\ No newline at end of file
@@ -1,8 +1,16 @@
 # -*- encoding: utf-8 -*-
 
+import datetime
+import gc
+import gzip
 import json
+import os
+import shutil
+import tempfile
 from glob import glob
-from log_parse import parse
+from log_parse import ApproximateTopUrls, Follower, LatencyPercentiles, LineFilter, ParseCache, RequestTypes, \
+    SlowQueries, TimeIndex, TopUrls, \
+    analyze, analyze_parallel, fast_params_from_line, get_params_from_line, parse
 
 error_message = 'Ошибка в файле {}. Expected: "{}", got: "{}"'
 
@@ -21,5 +29,365 @@ def run_tests():
     print("All tests passed!")
 
 
+def run_stream_tests():
+    # the log split into a plain and a gzipped part gives the same answers
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with open('log.log', 'rb') as log_file:
+            lines = log_file.readlines()
+        first_part = os.path.join(tmp_dir, 'log.log.1')
+        second_part = os.path.join(tmp_dir, 'log.log.2.gz')
+        with open(first_part, 'wb') as part_file:
+            part_file.writelines(lines[:len(lines) // 2])
+        with gzip.open(second_part, 'wb') as part_file:
+            part_file.writelines(lines[len(lines) // 2:])
+
+        for filename in glob('tests/*.json'):
+            data = json.load(open(filename))
+            got = parse(files=[first_part, second_part], **data['params'])
+            if got != data['response']:
+                print("Ошибка при чтении нескольких файлов, получен: {} ожидался: {}, файл {}".format(
+                    str(got), str(data['response']), filename
+                ))
+                return
+
+        with open(first_part, 'rb') as part_file:
+            top, types = analyze([part_file, second_part], [TopUrls(), RequestTypes()])
+            gc.collect()
+            if part_file.closed:
+                print("Ошибка: файл вызывающего закрыт после разбора")
+                return
+        requests_number = sum(1 for line in lines if get_params_from_line(line.decode()))
+        if top != parse() or sum(types.values()) != requests_number:
+            print("Ошибка при подсчете нескольких агрегатов за один проход: {} {}".format(top, types))
+            return
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Stream tests passed!")
+
+
+def run_parallel_tests():
+    # small chunks cut the log in many places, stop_at falls inside one of them
+    dates = [None, datetime.datetime(2018, 3, 18, 11, 19, 40), datetime.datetime(2018, 3, 23, 11, 17, 28)]
+    for start_at in dates:
+        for stop_at in dates:
+            for aggregator in (TopUrls, SlowQueries):
+                expected = analyze(['log.log'], [aggregator()], start_at=start_at, stop_at=stop_at)
+                got = analyze_parallel(['log.log'], [aggregator()], 2, chunk_size=512,
+                                       start_at=start_at, stop_at=stop_at)
+                if got != expected:
+                    print("Ошибка параллельного разбора, получен: {} ожидался: {}, {} - {}".format(
+                        got, expected, start_at, stop_at
+                    ))
+                    return
+
+    for filename in glob('tests/*.json'):
+        data = json.load(open(filename))
+        got = parse(processes=2, **data['params'])
+        if got != data['response']:
+            print("Ошибка параллельного разбора, получен: {} ожидался: {}, файл {}".format(
+                str(got), str(data['response']), filename
+            ))
+            return
+
+    # opened files are parsed in one process
+    with open('log.log', 'rb') as log_file:
+        got = parse(files=[log_file], processes=2)
+    if got != parse():
+        print("Ошибка параллельного разбора открытого файла, получен: {}".format(got))
+        return
+    print("Parallel tests passed!")
+
+
+def run_filter_tests():
+    # one filter serves several calls and processes with the same results as the options
+    urls = [parsed_params[2] for parsed_params in map(get_params_from_line, open('log.log')) if parsed_params]
+    ignore_urls = urls[::7] + ['www.' + url for url in urls[1::11]] + ['/missing/{}'.format(i) for i in range(1000)]
+    for options in (dict(ignore_urls=ignore_urls),
+                    dict(ignore_urls=ignore_urls, ignore_www=True, ignore_files=True),
+                    dict(ignore_urls=ignore_urls, request_type='GET',
+                         start_at=datetime.datetime(2018, 3, 18, 11, 19, 40),
+                         stop_at=datetime.datetime(2018, 3, 23, 11, 17, 28))):
+        line_filter = LineFilter(**options)
+        expected = analyze(['log.log'], [TopUrls()], **options)
+        for got in (analyze(['log.log'], [TopUrls()], line_filter=line_filter),
+                    analyze(['log.log'], [TopUrls()], line_filter=line_filter),
+                    analyze_parallel(['log.log'], [TopUrls()], 2, chunk_size=512, line_filter=line_filter)):
+            if got != expected:
+                print("Ошибка фильтра, получен: {} ожидался: {}, {}".format(got, expected, options))
+                return
+    print("Filter tests passed!")
+
+
+def run_parser_tests():
+    odd_lines = [
+        '[1/Mar/2018 11:19:40] "GET https://sys.mail.ru/ HTTP/1.1" 200 965',
+        '[01/mar/2018 11:19:40] "GET https://sys.mail.ru/ HTTP/1.1" 200 965',
+        '[31/Feb/2018 11:19:40] "GET https://sys.mail.ru/ HTTP/1.1" 200 965',
+        '[01/Mar/2018 24:00:00] "GET https://sys.mail.ru/ HTTP/1.1" 200 965',
+        '  [01/Mar/2018 11:19:40]  " GET  https://u:p@sys.mail.ru:80/a?b#c  HTTP/1.1 " 200 965 ',
+        '[01/Mar/2018 11:19:40] "GET sys.mail.ru/a HTTP/1.1" 200 965',
+        '[01/Mar/2018 11:19:40] "GET https://sys.mail.ru/a HTTP/1.1" 200',
+        '[01/Mar/2018 11:19:40] "GET https://sys.mail.ru/a HTTP/1.1 200 965',
+        '[01/Mar/2018 11:19:40] x "GET https://sys.mail.ru/a HTTP/1.1" 200 965',
+    ]
+    with open('log.log') as log_file:
+        lines = log_file.readlines()
+    for line in lines + odd_lines:
+        if fast_params_from_line(line) != get_params_from_line(line):
+            print("Ошибка быстрого разбора строки {!r}: {} вместо {}".format(
+                line, fast_params_from_line(line), get_params_from_line(line)
+            ))
+            return
+    print("Parser tests passed!")
+
+
+def run_index_tests():
+    dates = [None, datetime.datetime(2018, 3, 20, 11, 15, 49), datetime.datetime(2018, 3, 23, 11, 17, 28),
+             datetime.datetime(2018, 3, 28, 11, 19, 40), datetime.datetime(2018, 4, 1)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'log.log')
+        with open('log.log', 'rb') as log_file:
+            lines = log_file.readlines()
+        # the index is built for the first half and extended when the rest is written
+        with open(path, 'wb') as part_file:
+            part_file.writelines(lines[:len(lines) // 2])
+        TimeIndex(path, step=256).update()
+        with open(path, 'ab') as part_file:
+            part_file.writelines(lines[len(lines) // 2:])
+        index = TimeIndex(path, step=256)
+        index.update()
+        shutil.copy('log.log', path + '.copy')
+        fresh_index = TimeIndex(path + '.copy', step=256)
+        fresh_index.update()
+        if index.indexed != os.path.getsize(path) or index.max_dates[-1] != fresh_index.max_dates[-1] or \
+                index.seek_offset(dates[3]) == 0:
+            print("Ошибка построения индекса: {} {}".format(index.offsets, index.max_dates))
+            return
+
+        for start_at in dates:
+            for stop_at in dates:
+                for aggregator in (TopUrls, SlowQueries):
+                    expected = analyze([path], [aggregator()], start_at=start_at, stop_at=stop_at)
+                    got = analyze([path], [aggregator()], start_at=start_at, stop_at=stop_at,
+                                  time_index=True)
+                    got_parallel = analyze_parallel([path], [aggregator()], 2, chunk_size=512,
+                                                    start_at=start_at, stop_at=stop_at, time_index=True)
+                    if got != expected or got_parallel != expected:
+                        print("Ошибка чтения по индексу, получен: {} ожидался: {}, {} - {}".format(
+                            got, expected, start_at, stop_at
+                        ))
+                        return
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Index tests passed!")
+
+
+def run_cache_tests():
+    # the cache gives the same requests as parsing, any response time comes back as it was
+    odd_lines = [
+        '[18/Mar/2018 11:19:41] "GET https://sys.mail.ru/ HTTP/1.1" 200 007\n',
+        '[18/Mar/2018 11:19:41] "GET https://sys.mail.ru/ HTTP/1.1" 200 -5\n',
+        '[18/Mar/2018 11:19:42] "GET https://sys.mail.ru/ HTTP/1.1" 200 слишком\n',
+        '[18/Mar/2018 11:19:42] "POST http://почта.рф/ HTTP/1.1" 200 99999999999999999999\n',
+        'not a request\n',
+    ]
+    dates = [None, datetime.datetime(2018, 3, 20, 11, 15, 49), datetime.datetime(2018, 3, 28, 11, 19, 40)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'log.log')
+        shutil.copy('log.log', path)
+        with open(path, 'a', encoding='utf-8') as log_file:
+            log_file.writelines(odd_lines)
+        expected = [fast_params_from_line(line) for line in open(path, encoding='utf-8')]
+        expected = [parsed_params for parsed_params in expected if parsed_params]
+        for attempt in ('построен', 'прочитан'):
+            got = list(ParseCache(path).params())
+            if got != expected or not os.path.exists(path + '.cache'):
+                print("Ошибка кеша разбора: кеш {} неверно".format(attempt))
+                return
+
+        for start_at in dates:
+            for stop_at in dates:
+                for aggregator in (TopUrls, SlowQueries):
+                    options = dict(start_at=start_at, stop_at=stop_at, ignore_www=True, request_type='GET')
+                    if analyze([path], [aggregator()], cache=True, **options) != \
+                            analyze([path], [aggregator()], **options):
+                        print("Ошибка запроса по кешу разбора: {} - {}".format(start_at, stop_at))
+                        return
+
+        # a changed log is parsed again
+        with open(path, 'a', encoding='utf-8') as log_file:
+            log_file.write('[18/Mar/2018 11:19:43] "GET https://new.mail.ru/ HTTP/1.1" 200 1\n')
+        if list(ParseCache(path).params())[-1][2] != 'new.mail.ru/':
+            print("Ошибка кеша разбора: измененный лог не разобран заново")
+            return
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Cache tests passed!")
+
+
+def run_follow_tests():
+    # the log grows, is rotated to log.log.1 and a new log is started
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'log.log')
+        checkpoint = os.path.join(tmp_dir, 'checkpoint')
+        with open('log.log', 'rb') as log_file:
+            lines = log_file.readlines()
+        parts = [lines[:40], lines[40:80], lines[80:]]
+        for filename in glob('tests/*.json'):
+            data = json.load(open(filename))
+            for name in (path, path + '.1', checkpoint):
+                if os.path.exists(name):
+                    os.remove(name)
+
+            with open(path, 'wb') as log_file:
+                log_file.writelines(parts[0])
+                log_file.write(parts[1][0][:10])
+            parse(files=[path], checkpoint=checkpoint, **data['params'])
+            with open(path, 'ab') as log_file:
+                log_file.write(parts[1][0][10:])
+                log_file.writelines(parts[1][1:])
+            parse(files=[path], checkpoint=checkpoint, **data['params'])
+            with open(path, 'ab') as log_file:
+                log_file.writelines(parts[2][:10])
+            os.rename(path, path + '.1')
+            with open(path, 'wb') as log_file:
+                log_file.writelines(parts[2][10:])
+            got = parse(files=[path], checkpoint=checkpoint, **data['params'])
+            if got != data['response']:
+                print("Ошибка при чтении растущего лога, получен: {} ожидался: {}, файл {}".format(
+                    str(got), str(data['response']), filename
+                ))
+                return
+
+        # stop_at passed in the first part ends reading for good
+        stop_at = datetime.datetime(2018, 3, 20, 11, 15, 49)
+        path = os.path.join(tmp_dir, 'stop.log')
+        with open(path, 'wb') as log_file:
+            log_file.writelines(parts[0])
+        Follower(path, [TopUrls()], checkpoint + '.stop', stop_at=stop_at).poll()
+        with open(path, 'ab') as log_file:
+            log_file.writelines(parts[1] + parts[2])
+        got = Follower(path, [TopUrls()], checkpoint + '.stop', stop_at=stop_at).poll()
+        if got != analyze(['log.log'], [TopUrls()], stop_at=stop_at):
+            print("Ошибка остановки по stop_at при чтении растущего лога: {}".format(got))
+            return
+
+        try:
+            parse(files=[path, path], checkpoint=checkpoint + '.two')
+            print("Ошибка: чтение растущего лога приняло два файла")
+            return
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Follow tests passed!")
+
+
+def run_approximate_tests():
+    # with room for every url the answer is exact, with less room every
+    # count is at most error_bound() above the real one
+    for filename in glob('tests/*.json'):
+        data = json.load(open(filename))
+        if data['params'].get('slow_queries'):
+            continue
+        got = parse(max_error=0.001, **data['params'])
+        if got != data['response']:
+            print("Ошибка приближенного подсчета, получен: {} ожидался: {}, файл {}".format(
+                str(got), str(data['response']), filename
+            ))
+            return
+
+    exact, = analyze(['log.log'], [TopUrls()])
+    for max_error in (0.05, 0.1, 0.25):
+        approximate = ApproximateTopUrls(max_error)
+        merged = ApproximateTopUrls(max_error)
+        got, = analyze(['log.log'], [approximate])
+        got_merged, = analyze_parallel(['log.log'], [merged], 2, chunk_size=2048)
+        for summary, result in ((approximate, got), (merged, got_merged)):
+            if len(summary.urls) > summary.capacity or \
+                    any(not real <= count <= real + summary.error_bound()
+                        for real, count in zip(exact, result)):
+                print("Ошибка приближенного подсчета, получен: {} точный: {}, погрешность {}".format(
+                    result, exact, summary.error_bound()
+                ))
+                return
+    print("Approximate tests passed!")
+
+
+def run_columns_tests():
+    try:
+        from log_columns import LogColumns, export_columns
+        import numpy
+    except ImportError:
+        print("Columns tests skipped: numpy is not installed")
+        return
+
+    dates = [None, datetime.datetime(2018, 3, 20, 11, 15, 49), datetime.datetime(2018, 3, 23, 11, 17, 28)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        export_columns(['log.log'], tmp_dir)
+        columns = LogColumns(tmp_dir)
+        cases = [json.load(open(filename)) for filename in glob('tests/*.json')]
+        cases += [{'params': {'start_at': start_at, 'stop_at': stop_at, 'slow_queries': slow_queries,
+                              'ignore_www': True, 'ignore_urls': ['sys.mail.ru/calendar/config/254/40263/']}}
+                  for start_at in dates for stop_at in dates for slow_queries in (False, True)]
+        cases += [{'params': {'request_type': request_type}} for request_type in ('GET', 'PUT')]
+        for data in cases:
+            params = dict(data['params'])
+            expected = parse(**params)
+            query = columns.slow_queries if params.pop('slow_queries', False) else columns.top_urls
+            got = query(**params)
+            if got != expected:
+                print("Ошибка запроса к колонкам, получен: {} ожидался: {}, {}".format(
+                    got, expected, data['params']
+                ))
+                return
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Columns tests passed!")
+
+
+def run_percentiles_tests():
+    # every percentile is within the relative error of the real one and
+    # merged sketches are the same as the sketch of one pass
+    response_times = dict()
+    for line in open('log.log'):
+        parsed_params = get_params_from_line(line)
+        if parsed_params and parsed_params[3].isdigit():
+            response_times.setdefault(parsed_params[2], []).append(int(parsed_params[3]))
+
+    percentiles = LatencyPercentiles(relative_error=0.02)
+    report, = analyze(['log.log'], [percentiles], ignore_www=False)
+    for url, times in response_times.items():
+        times.sort()
+        for q, got in zip((50, 95, 99), percentiles.report()[url]):
+            expected = times[int(q / 100 * (len(times) - 1))]
+            if abs(got - expected) > 0.02 * expected + 1:
+                print("Ошибка перцентиля {} для {}: получен {} ожидался {}".format(q, url, got, expected))
+                return
+
+    merged = LatencyPercentiles(relative_error=0.02)
+    analyze_parallel(['log.log'], [merged], 2, chunk_size=512)
+    if merged.report() != percentiles.report() or \
+            parse(slow_queries=True, percentile=99) != analyze(['log.log'], [LatencyPercentiles()])[0]:
+        print("Ошибка объединения перцентилей")
+        return
+    print("Percentiles tests passed!")
+
+
 if __name__ == '__main__':
     run_tests()
+    run_stream_tests()
+    run_parallel_tests()
+    run_filter_tests()
+    run_parser_tests()
+    run_index_tests()
+    run_cache_tests()
+    run_follow_tests()
+    run_approximate_tests()
+    run_columns_tests()
+    run_percentiles_tests()
@@ -1,52 +1,191 @@
 # -*- encoding: utf-8 -*-
+import bisect
+import json
+
+# вагоны поезда лежат блоками не длиннее BLOCK_SIZE
+BLOCK_SIZE = 128
+
+
+class Car:
+    __slots__ = ('name', 'people', 'block', 'position')
+
+    def __init__(self, name, people):
+        self.name = name
+        self.people = people
+        self.block = None
+        self.position = 0
+
+
+class Block:
+    # offset - номер первого вагона блока в поезде
+    __slots__ = ('cars', 'train', 'offset')
+
+    def __init__(self, cars):
+        self.cars = cars
+        self.train = None
+        self.offset = 0
+        for position, car in enumerate(cars):
+            car.block = self
+            car.position = position
+
+
+class Train:
+    # поезд - цепочка блоков, при перецепке блоки переходят целиком и
+    # разрезается только один, так что вагоны перенумеровываются лишь в нем
+    __slots__ = ('blocks', 'offsets', 'length')
+
+    def __init__(self, cars):
+        self.blocks = []
+        self.offsets = []
+        self.length = 0
+        for start in range(0, len(cars), BLOCK_SIZE):
+            self.append(Block(cars[start:start + BLOCK_SIZE]))
+
+    def append(self, block):
+        last = self.blocks[-1] if self.blocks else None
+        if last is not None and len(last.cars) + len(block.cars) <= BLOCK_SIZE:
+            # короткие блоки на стыке склеиваются
+            for car in block.cars:
+                car.block = last
+                car.position = len(last.cars)
+                last.cars.append(car)
+        else:
+            block.train = self
+            block.offset = self.length
+            self.blocks.append(block)
+            self.offsets.append(self.length)
+        self.length += len(block.cars)
+
+    def car(self, index):
+        block = self.blocks[bisect.bisect_right(self.offsets, index) - 1]
+        return block.cars[index - block.offset]
+
+    def cut(self, count):
+        # отцепляет count вагонов с конца
+        moved = []
+        self.length -= count
+        while count:
+            block = self.blocks[-1]
+            if len(block.cars) <= count:
+                self.blocks.pop()
+                self.offsets.pop()
+                moved.append(block)
+                count -= len(block.cars)
+            else:
+                tail = Block(block.cars[-count:])
+                del block.cars[-count:]
+                moved.append(tail)
+                break
+        moved.reverse()
+        return moved
+
+
+class Railway:
+    # для каждого пассажира известен его вагон, вагон знает свой блок и
+    # номер в нем, блок - поезд и свой номер в поезде
+    def __init__(self, data):
+        self.trains = dict()
+        self.train_list = []
+        self.passengers = dict()
+        self.cars = dict()
+        car_count = 0
+        for train_data in data:
+            cars = [Car(car['name'], set(car['people'])) for car in train_data['cars']]
+            for car in cars:
+                self.cars.setdefault(car.name, car)
+                for passenger in car.people:
+                    self.passengers.setdefault(passenger, car)
+            car_count += len(cars)
+            train = Train(cars)
+            self.train_list.append(train)
+            self.trains.setdefault(train_data['name'], train)
+        # вагон с повторяющимся именем ищется по порядку поездов
+        self.unique_cars = len(self.cars) == car_count
+
+    def apply(self, event):
+        # False если событие невозможно
+        if event['type'] == "walk":
+            return self.walk(event['passenger'], event['distance'])
+        return self.switch(event['train_from'], event['train_to'], event['cars'])
+
+    def walk(self, passenger, distance):
+        car = self.passengers.get(passenger)
+        if car is None:
+            return False
+        block = car.block
+        position = car.position + distance
+        if 0 <= position < len(block.cars):
+            target = block.cars[position]
+        else:
+            index = block.offset + position
+            if index < 0 or index >= block.train.length:
+                return False
+            target = block.train.car(index)
+        car.people.remove(passenger)
+        target.people.add(passenger)
+        self.passengers[passenger] = target
+        return True
+
+    def switch(self, train_from, train_to, count):
+        train = self.trains.get(train_from)
+        if train is None or train.length < count or count < 0:
+            return False
+        if train_to not in self.trains:
+            return False
+        # как и срез [-0:], ноль вагонов означает весь поезд
+        for block in train.cut(count or train.length):
+            self.trains[train_to].append(block)
+        return True
+
+    def count(self, car_name):
+        if self.unique_cars:
+            car = self.cars.get(car_name)
+            return len(car.people) if car is not None else -1
+        for train in self.train_list:
+            for block in train.blocks:
+                for car in block.cars:
+                    if car.name == car_name:
+                        return len(car.people)
+        return -1
+
 
 def process(data, events, car):
-	trains = list(data)
-	for event in events:
-   		if event['type'] == "walk":
-   			passenger_exists = False
-   			passenger = event['passenger']
-   			for train in trains:
-				for car_number in range(len(train['cars'])):
-   					car_temp = train['cars'][car_number]
-   					if passenger in car_temp['people']:
-   						passenger_exists = True
-   						car_temp['people'].remove(passenger)
-   						if (car_number + event['distance'] < 0) or (car_number + event['distance'] >= len(train['cars'])):
-   							return -1
-
-   						train['cars'][car_number + event['distance']]['people'].append(passenger)
-   						break
-
-   			if not passenger_exists:
-   				return -1
-
-   		else:
-   			train_from_exists = False
-   			for train in trains:
-   				if train['name'] == event['train_from']:
-   					if (len(train['cars']) < event['cars']) or (event['cars'] < 0):
-   						return -1
-
-   					train_from_exists = True
-   					cars = train['cars'][-event['cars']:]
-   					train['cars'] = train['cars'][:-event['cars']]
-   					break  # после нахождения нужного поезда далее итерировать не обязательно
-   			if not train_from_exists:
-   				return -1
-
-   			train_to_exists = False
-   			for train in trains:
-   				if train['name'] == event['train_to']:
-   					train_to_exists = True
-   					train['cars'] += cars
-   					break
-   			if not train_to_exists:
-   				return -1
-
-   	for train in trains:
-   		for car_temp in train['cars']:
-   			if car_temp['name'] == car:
-   				return len(car_temp['people'])
-
-	return -1
+    railway = Railway(data)
+    for event in events:
+        if not railway.apply(event):
+            return -1
+    return railway.count(car)
+
+
+def process_stream(data, events, queries):
+    # queries - пары (N, car): сколько пассажиров в вагоне car после N событий.
+    # События читаются по одному, ответы в порядке запросов; после
+    # невалидного события и за концом потока ответ -1
+    railway = Railway(data)
+    answers = [-1] * len(queries)
+    events = iter(events)
+    done = 0
+    for number, (after, car) in sorted(enumerate(queries), key=lambda query: query[1][0]):
+        while done < after:
+            event = next(events, None)
+            try:
+                valid = event is not None and railway.apply(event)
+            except (KeyError, TypeError):
+                valid = False
+            if not valid:
+                return answers
+            done += 1
+        answers[number] = railway.count(car)
+    return answers
+
+
+def read_events(path):
+    # события по одному json на строку, нечитаемая строка - невалидное событие
+    with open(path, encoding='utf-8') as events_file:
+        for line in events_file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield {}
@@ -1,9 +1,11 @@
 # -*- encoding: utf-8 -*-
 
 import json
+import os
+import tempfile
 from glob import glob
 
-from passangers import process
+from passangers import process, process_stream, read_events
 
 error_message = 'ERROR in file {}. Expected: "{}", got: "{}"'
 
@@ -20,5 +22,26 @@ def run_tests():
     print("All tests passed!")
 
 
+def run_stream_tests():
+    # a query after every event, events are read from a file
+    for filename in glob('tests/*.json'):
+        data = json.load(open(filename))
+        trains, events, result = data['trains'], data['events'], data['result']
+        queries = [(number, result['car']) for number in range(len(events), -1, -1)]
+        expected = [process(trains, events[:number], car) for number, car in queries]
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as events_file:
+                events_file.writelines(json.dumps(event) + '\n' for event in events)
+            got = process_stream(trains, read_events(path), queries)
+        finally:
+            os.remove(path)
+        if got != expected or got[0] != result['amount']:
+            print(error_message.format(filename, expected, got))
+            return
+    print("Stream tests passed!")
+
+
 if __name__ == '__main__':
     run_tests()
+    run_stream_tests()
@@ -0,0 +1,241 @@
+import collections
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+COMMANDS = ('add', 'get', 'ack', 'in')
+
+
+def start_server(port, mode, workdir, shards=1, storage='memory', commit='sync'):
+    # the server gets its own process group, so kill -9 reaches shard workers too
+    server = subprocess.Popen([sys.executable, SERVER, str(port), '--mode=' + mode,
+                               '--shards={}'.format(shards), '--storage=' + storage,
+                               '--commit=' + commit],
+                              cwd=workdir, start_new_session=True, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.01)
+    server.kill()
+    raise RuntimeError("server didn't start")
+
+
+def send(port, command):
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(command)
+    chunks = []
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    s.close()
+    return b''.join(chunks)
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in COMMANDS:
+            raise ValueError('unknown command in mix: ' + name)
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+def client(port, queue, payload, mix, stop_at, latencies, seed):
+    # ACK needs a task taken by GET and IN a task added earlier, while there
+    # is none the client sends GET or ADD instead
+    rand = random.Random(seed)
+    names, weights = zip(*mix)
+    add_command = 'ADD {} {} '.format(queue, len(payload)).encode() + payload
+    added = collections.deque(maxlen=1000)
+    taken = []
+    moved = 0
+    while time.time() < stop_at:
+        name = rand.choices(names, weights)[0]
+        if name == 'ack' and not taken:
+            name = 'get'
+        elif name == 'in' and not added:
+            name = 'add'
+
+        if name == 'add':
+            request = add_command
+        elif name == 'get':
+            request = 'GET {}'.format(queue).encode()
+        elif name == 'ack':
+            request = 'ACK {} '.format(queue).encode() + taken.pop()
+        else:
+            request = 'IN {} '.format(queue).encode() + rand.choice(added)
+
+        started = time.perf_counter()
+        response = send(port, request)
+        latencies[name].append(time.perf_counter() - started)
+
+        if name == 'add':
+            added.append(response)
+            moved += len(payload)
+        elif name == 'get' and response != b'NONE':
+            taken.append(response.split(b' ', 1)[0])
+            moved += len(payload)
+    latencies['bytes'].append(moved)
+
+
+def client_process(port, queues, payload, mix, stop_at, results, seed):
+    latencies = collections.defaultdict(list)
+    threads = [threading.Thread(target=client,
+                                args=(port, queue, payload, mix, stop_at, latencies, seed + i))
+               for i, queue in enumerate(queues)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(dict(latencies))
+
+
+def slow_producer(port, size, stop_at):
+    # uploads a large ADD in small pieces, like a client on a slow link
+    payload = b'x' * size
+    command = 'ADD slow {} '.format(size).encode() + payload
+    while time.time() < stop_at:
+        s = socket.create_connection(('127.0.0.1', port))
+        for offset in range(0, len(command), 64 * 1024):
+            s.sendall(command[offset:offset + 64 * 1024])
+            time.sleep(0.05)
+        s.recv(128)
+        s.close()
+
+
+def peak_rss(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return None
+
+
+def disk_usage(workdir):
+    return sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)
+               if os.path.isfile(os.path.join(workdir, name)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_load(port, clients, processes, duration, payload, mix, slow):
+    # clients are threads spread over several processes, so the load
+    # generator itself isn't limited by one GIL
+    stop_at = time.time() + duration
+    queues = ['q{}'.format(i % 10) for i in range(clients)]
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=client_process,
+                                       args=(port, queues[i::processes], payload, mix,
+                                             stop_at, results, i * clients))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    if slow:
+        slow_thread = threading.Thread(target=slow_producer, args=(port, 1000000, stop_at))
+        slow_thread.start()
+
+    latencies = collections.defaultdict(list)
+    for _ in workers:
+        for name, values in results.get().items():
+            latencies[name].extend(values)
+    for worker in workers:
+        worker.join()
+    if slow:
+        slow_thread.join()
+    return latencies
+
+
+def measure_recovery(server, port, mode, workdir, shards, storage, commit):
+    os.killpg(server.pid, signal.SIGKILL)
+    server.wait()
+    started = time.time()
+    server = start_server(port, mode, workdir, shards, storage, commit)
+    # shard workers replay their journals behind an already listening router,
+    # the first answer to STATS means every shard is up
+    send(port, b'STATS')
+    return server, time.time() - started
+
+
+def bench(mode, port, clients, duration, payload_size, slow, shards=1, processes=1,
+          mix=(('add', 1), ('get', 1), ('ack', 1)), storage='memory', recovery=False,
+          commit='sync'):
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(port, mode, workdir, shards, storage, commit)
+        try:
+            latencies = run_load(port, clients, processes, duration, b'x' * payload_size,
+                                 mix, slow)
+            rss = peak_rss(server.pid)
+            disk = disk_usage(workdir)
+            recovery_time = None
+            if recovery:
+                server, recovery_time = measure_recovery(server, port, mode, workdir,
+                                                         shards, storage, commit)
+        finally:
+            server.terminate()
+            server.wait()
+
+    moved = sum(latencies.pop('bytes', []))
+    total = sum(len(values) for values in latencies.values())
+    print("{:10} {:8.0f} ops/s  {:8.1f} MB/s  peak RSS {} MB  disk {:.1f} MB{}".format(
+        mode, total / duration, moved / duration / 2 ** 20, rss, disk / 2 ** 20,
+        '' if recovery_time is None else '  recovery {:.2f} s'.format(recovery_time)))
+    for name in COMMANDS:
+        values = latencies.get(name)
+        if values:
+            print("  {:8} {:8.0f} ops/s  p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms".format(
+                name.upper(), len(values) / duration, percentile(values, 50) * 1000,
+                percentile(values, 95) * 1000, percentile(values, 99) * 1000))
+
+
+def main(argv):
+    options = {'clients': '50', 'processes': '1', 'duration': '5', 'payload': '100',
+               'port': '8090', 'modes': 'blocking,async', 'slow': '', 'shards': '1',
+               'mix': 'add=1,get=1,ack=1', 'storage': 'memory', 'recovery': '',
+               'commit': 'sync'}
+    usage = ("Usage: python3 bench.py [--clients=N] [--processes=N] [--duration=SEC] "
+             "[--payload=BYTES] [--port=PORT] [--modes=blocking,async] [--slow] [--shards=N] "
+             "[--mix=add=1,get=1,ack=1,in=1] [--storage=memory|disk] [--recovery] "
+             "[--commit=sync|group]")
+    for arg in argv:
+        name, _, value = arg.lstrip('-').partition('=')
+        if name not in options:
+            print(usage)
+            return
+        options[name] = value or 'yes'
+    try:
+        mix = parse_mix(options['mix'])
+    except ValueError:
+        print(usage)
+        return
+
+    for mode in options['modes'].split(','):
+        bench(mode, int(options['port']), int(options['clients']), float(options['duration']),
+              int(options['payload']), bool(options['slow']), int(options['shards']),
+              min(int(options['processes']), int(options['clients'])), mix,
+              options['storage'], bool(options['recovery']), options['commit'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
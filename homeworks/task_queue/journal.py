@@ -0,0 +1,160 @@
+import asyncio
+import io
+import os
+import pickle
+import struct
+import zlib
+
+
+class Journal:
+    # body length, number of out-of-band data buffers, checksum
+    _header = struct.Struct('>III')
+    _buffer_length = struct.Struct('>I')
+
+    def __init__(self, filename, group_commit=False):
+        self._filename = filename
+        self._file = None
+        self.records = 0
+        # bytes in the file, compaction is triggered relative to the snapshot size
+        self.size = 0
+        # with group commit append only writes, records become durable on
+        # sync() or wait_synced(), one fsync covers everything appended so far
+        self._group_commit = group_commit
+        self._appended = 0
+        self._synced = 0
+        self._syncing = None
+        self.fsyncs = 0
+
+    def append(self, *records):
+        if self._file is None:
+            self._file = open(self._filename, 'ab')
+
+        chunks = []
+        for record in records:
+            buffers = []
+            body = dumps(record, buffers.append)
+            raws = [buffer.raw() for buffer in buffers]
+            lengths = b''.join(self._buffer_length.pack(raw.nbytes) for raw in raws)
+            checksum = zlib.crc32(body, zlib.crc32(lengths))
+            for raw in raws:
+                checksum = zlib.crc32(raw, checksum)
+            chunks.append(self._header.pack(len(body), len(raws), checksum))
+            chunks.append(lengths)
+            chunks.append(body)
+            chunks.extend(raws)
+        self._file.writelines(chunks)
+        self.records += len(records)
+        self.size += sum(len(chunk) for chunk in chunks)
+        self._appended += 1
+        if not self._group_commit:
+            self.sync()
+
+    def sync(self):
+        if self._synced == self._appended:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.fsyncs += 1
+        self._synced = self._appended
+
+    async def wait_synced(self):
+        # clients that append while an fsync is running wait for the next
+        # one, which covers the records of all of them
+        target = self._appended
+        while self._synced < target:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._sync_in_thread())
+            await asyncio.shield(self._syncing)
+
+    async def _sync_in_thread(self):
+        try:
+            target = self._appended
+            # a reset after this task was scheduled already made everything durable
+            if self._synced >= target or self._file is None:
+                return
+            self._file.flush()
+            # the journal may be reset while fsync runs, the duplicate
+            # descriptor stays valid until it is done
+            fd = os.dup(self._file.fileno())
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, os.fsync, fd)
+            finally:
+                os.close(fd)
+            self.fsyncs += 1
+            self._synced = max(self._synced, target)
+        finally:
+            self._syncing = None
+
+    def replay(self):
+        # a crash in the middle of append leaves a torn record at the tail:
+        # everything before it is valid, the tail is cut off
+        good_offset = 0
+        try:
+            with open(self._filename, 'rb') as journal_file:
+                while True:
+                    record = self._read_record(journal_file)
+                    if record is None:
+                        break
+                    good_offset = journal_file.tell()
+                    self.records += 1
+                    yield record
+        except FileNotFoundError:
+            return
+
+        self.size = good_offset
+        if good_offset != os.path.getsize(self._filename):
+            with open(self._filename, 'r+b') as journal_file:
+                journal_file.truncate(good_offset)
+
+    def _read_record(self, journal_file):
+        header = journal_file.read(self._header.size)
+        if len(header) < self._header.size:
+            return None
+        length, buffers_number, checksum = self._header.unpack(header)
+        lengths = journal_file.read(buffers_number * self._buffer_length.size)
+        if len(lengths) < buffers_number * self._buffer_length.size:
+            return None
+        body = journal_file.read(length)
+        if len(body) < length:
+            return None
+        raws = []
+        actual_checksum = zlib.crc32(body, zlib.crc32(lengths))
+        for raw_length, in self._buffer_length.iter_unpack(lengths):
+            raw = journal_file.read(raw_length)
+            if len(raw) < raw_length:
+                return None
+            actual_checksum = zlib.crc32(raw, actual_checksum)
+            raws.append(raw)
+        if actual_checksum != checksum:
+            return None
+        return pickle.loads(body, buffers=raws)
+
+    def reset(self):
+        # called after a snapshot was written, it holds everything appended
+        self.close()
+        with open(self._filename, 'wb') as journal_file:
+            os.fsync(journal_file.fileno())
+        self.records = 0
+        self.size = 0
+        self._synced = self._appended
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _Pickler(pickle.Pickler):
+    # task data kept as memoryview slices of received commands are written
+    # straight from those buffers and come back as bytes
+    def reducer_override(self, obj):
+        if isinstance(obj, memoryview):
+            return bytes, (pickle.PickleBuffer(obj),)
+        return NotImplemented
+
+
+def dumps(obj, buffer_callback=None):
+    body = io.BytesIO()
+    _Pickler(body, 5, buffer_callback=buffer_callback).dump(obj)
+    return body.getvalue()
+
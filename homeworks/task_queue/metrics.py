@@ -0,0 +1,67 @@
+import time
+
+# latency buckets are powers of two in microseconds: 1us ... ~67s
+BUCKETS = 27
+
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        microseconds = int(seconds * 1000000)
+        self.buckets[min(microseconds.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self):
+        self._counters = dict()
+        self._histograms = dict()
+        self.clock = time.perf_counter
+
+    def inc(self, name, value=1):
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def dump(self, gauges):
+        lines = ['{} {}'.format(name, value) for name, value in gauges]
+        for name, value in sorted(self._counters.items()):
+            lines.append('{} {}'.format(name, value))
+        for name, histogram in sorted(self._histograms.items()):
+            cumulative = 0
+            for bucket, count in enumerate(histogram.buckets):
+                cumulative += count
+                if count:
+                    lines.append('{}_seconds_bucket{{le="{}"}} {}'.format(
+                        name, (2 ** bucket) / 1000000, cumulative))
+            lines.append('{}_seconds_count {}'.format(name, histogram.count))
+            lines.append('{}_seconds_sum {:.6f}'.format(name, histogram.total))
+        return '\n'.join(lines)
+
+
+class NullMetrics:
+    # hot paths check `enabled` before reading the clock, so with metrics
+    # off a command costs one attribute lookup more
+    enabled = False
+
+    def inc(self, name, value=1):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+    def dump(self, gauges):
+        return '\n'.join('{} {}'.format(name, value) for name, value in gauges)
@@ -0,0 +1,116 @@
+import mmap
+import os
+
+
+class Payload:
+    __slots__ = ('store', 'offset', 'length')
+
+    def __init__(self, store, offset, length):
+        self.store = store
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class MappedFile:
+    # read-only file, task data in it is read lazily from the page cache
+    def __init__(self, filename):
+        with open(filename, 'rb') as mapped_file:
+            self.size = os.fstat(mapped_file.fileno()).st_size
+            self._map = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self.size else b''
+
+    def view(self, offset, length):
+        return memoryview(self._map)[offset:offset + length]
+
+    def read(self, payload):
+        return self.view(payload.offset, payload.length)
+
+
+class PayloadStore:
+    # task data is kept in memory until memory_budget bytes are used, the
+    # rest goes to a segment file and is read back through mmap; the file
+    # is scratch space, the journal and snapshots hold the durable copies.
+    # Data of tasks restored from a snapshot stays in the snapshot file
+    def __init__(self, filename, memory_budget=None):
+        self._filename = filename
+        self._memory_budget = memory_budget
+        self._file = None
+        self._map = None
+        self._size = 0
+        self.resident = 0
+        self.spilled = 0
+
+    def put(self, data):
+        if isinstance(data, memoryview) and data.obj is not None \
+                and 2 * data.nbytes < memoryview(data.obj).nbytes:
+            # a slice of a MADD command would keep the whole command alive
+            data = bytes(data)
+        if self._memory_budget is None or self.resident + len(data) <= self._memory_budget:
+            self.resident += len(data)
+            return data
+
+        if self._file is None:
+            self._file = open(self._filename, 'w+b')
+            self._size = 0
+        payload = Payload(self, self._size, len(data))
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self.spilled += len(data)
+        return payload
+
+    def read(self, data):
+        if not isinstance(data, Payload):
+            return data
+        if data.store is not self:
+            return data.store.read(data)
+        if self._map is None or len(self._map) < data.offset + data.length:
+            # memoryviews of a replaced map keep it alive until they are sent
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[data.offset:data.offset + data.length]
+
+    def release(self, data):
+        if not isinstance(data, Payload):
+            self.resident -= len(data)
+            return
+        if data.store is not self:
+            return
+        self.spilled -= data.length
+        if not self.spilled:
+            self._reset()
+
+    def needs_compaction(self):
+        return self._size > 2 * self.spilled + 64 * 1024 * 1024
+
+    def owns(self, data):
+        return isinstance(data, Payload) and data.store is self
+
+    def compact(self, payloads):
+        # live data is moved to a new file, the old one is never truncated
+        # in place because memoryviews of it may still be waiting to be sent
+        tmp_filename = self._filename + '.tmp'
+        size = 0
+        with open(tmp_filename, 'wb') as new_file:
+            for payload in payloads:
+                new_file.write(self.read(payload))
+                payload.offset = size
+                size += payload.length
+        self._reset()
+        os.replace(tmp_filename, self._filename)
+        self._file = open(self._filename, 'a+b')
+        self._size = size
+
+    def _reset(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._map = None
+        self._size = 0
+        if os.path.exists(self._filename):
+            os.remove(self._filename)
+
+    def close(self):
+        self._reset()
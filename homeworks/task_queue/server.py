@@ -1,138 +1,643 @@
+import asyncio
+import datetime
+import dbm
+import heapq
+import os
+import re
+import shelve
+import signal
 import socket
+import struct
 import sys
-import shelve
-import datetime
+import time
 from collections import OrderedDict
 
+from journal import Journal
+from metrics import Metrics, NullMetrics
+from payloads import Payload, PayloadStore
+from snapshot import Snapshot
+
+MAX_COMMAND_LENGTH = 5000000
+READ_CHUNK_SIZE = 65536
+MAX_SEND_CHUNKS = 512
+COMMAND_HEADER = re.compile(rb'(ADD|MADD)\s+(\S+)\s+(\d+)\s')
+INCOMPLETE_HEADER = re.compile(rb'M?ADD(\s+\S+)?(\s+\d+)?\s*\Z')
+TASK_HEADER = re.compile(rb'\s*(\d+)\s')
+INCOMPLETE_TASK_HEADER = re.compile(rb'\s*\d*\Z')
+TRAILING_SPACES = re.compile(rb'\s*\Z')
+FRAME_HEADER = struct.Struct('>I')
+SERVER_MODES = ('blocking', 'async')
+PROTOCOLS = ('simple', 'frames')
+STORAGES = ('memory', 'disk')
+COMMIT_MODES = ('sync', 'group')
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+OPTIONS = ('mode', 'protocol', 'storage', 'memory_budget', 'shards', 'metrics', 'metrics_file',
+           'commit')
+
 
 class Queues:
-    def __init__(self, timeout):
+    def __init__(self, timeout, filename='log', compact_every=10000, memory_budget=None,
+                 id_start=0, id_step=1, metrics=None, group_commit=False):
         self._queues = dict()
-        self._filename = 'log'
-        self._id_counter = 0
+        self._filename = filename
+        # shards of one server hand out ids id_start, id_start + id_step, ...
+        self._id_counter = id_start
+        self._id_step = id_step
         self._timedelta = datetime.timedelta(minutes=timeout)
         self._write_err_msg = "something was wrong when writing to file..."
+        self._journal = Journal(self._filename + '.journal', group_commit)
+        self._compact_every = compact_every
+        self._payloads = PayloadStore(self._filename + '.payloads', memory_budget)
+        self._snapshot = Snapshot(self._filename + '.snapshot')
+        # queues restored from the snapshot are loaded on first use,
+        # until then only their place in the snapshot is known
+        self._cold = dict()
+        self.recovery_time = None
+        self.metrics = metrics or NullMetrics()
+        # per queue: heap of ready tasks and in-flight tasks by their place
+        # in the order of adding, heap of in-flight tasks by deadline
+        self._seq_counter = 0
+        self._ready = dict()
+        self._in_flight = dict()
+        self._deadlines = dict()
 
     def add_command(self, queue_name, length, data):
-        if queue_name not in self._queues:
-            self._queues[queue_name] = OrderedDict()
-
-        task_id = str(self._id_counter)
-        running = False
-        time_get = None
-        task_params = [length, data, running, time_get]
-        self._queues[queue_name][task_id] = task_params
-        self._id_counter += 1
-        if not self.save_changes_to_file():
-            raise IOError(self._write_err_msg)
+        task_id, record = self._add(queue_name, length, data)
+        self._log(record)
 
         return task_id
 
     def get_command(self, queue_name):
+        tasks = self.get_tasks(queue_name, 1)
+        if not tasks:
+            return None
+
+        return b''.join(task_chunks(tasks))
+
+    def ack_command(self, queue_name, task_id):
+        self._warm(queue_name)
         if queue_name not in self._queues:
+            raise ValueError("{} doesn't exist".format(queue_name))
+        record = self._ack(queue_name, task_id)
+        if record is None:
+            return "NO"
+        self._log(record)
+        return "YES"
+
+    def madd_command(self, queue_name, count, *tasks):
+        added = [self._add(queue_name, length, data)
+                 for length, data in zip(tasks[::2], tasks[1::2])]
+        self._log(*[record for task_id, record in added])
+
+        return ' '.join(task_id for task_id, record in added)
+
+    def mget_command(self, queue_name, count):
+        tasks = self.get_tasks(queue_name, int(count))
+        if not tasks:
             return None
 
-        time_now = datetime.datetime.now()
-        for task_id, task_params in self._queues[queue_name].items():
-            if not task_params[2]:
-                task_params[2] = True
-                task_params[3] = time_now
-                if not self.save_changes_to_file():
-                    raise IOError(self._write_err_msg)
+        return b''.join(task_chunks(tasks))
 
-                return ' '.join([task_id, task_params[0], task_params[1]])
+    def get_tasks(self, queue_name, count):
+        self._warm(queue_name)
+        if queue_name not in self._queues:
+            return []
 
-        return None
+        taken = self._get(queue_name, count)
+        self._log(*[record for task_id, task_params, record in taken])
 
-    def ack_command(self, queue_name, task_id):
+        return [(task_id, task_params[0], self._payloads.read(task_params[1]))
+                for task_id, task_params, record in taken]
+
+    def mack_command(self, queue_name, *task_ids):
+        self._warm(queue_name)
         if queue_name not in self._queues:
             raise ValueError("{} doesn't exist".format(queue_name))
-        if self.in_command(queue_name, task_id) == 'NO':
-            status = "NO"
-        else:
-            self.check_timeout(queue_name, task_id)
-            if not self._queues[queue_name][task_id][2]:
-                status = "NO"
-            else:
-                self._queues[queue_name].pop(task_id)
-                status = "YES"
+        records = [self._ack(queue_name, task_id) for task_id in task_ids]
+        self._log(*[record for record in records if record is not None])
 
-        if not self.save_changes_to_file():
-            raise IOError(self._write_err_msg)
-        return status
+        return ' '.join("NO" if record is None else "YES" for record in records)
+
+    def _add(self, queue_name, length, data):
+        self._warm(queue_name)
+        if queue_name not in self._queues:
+            self._add_queue(queue_name)
+
+        task_id = str(self._id_counter)
+        running = False
+        time_get = None
+        task_params = [length, self._payloads.put(data), running, time_get]
+        self._queues[queue_name][task_id] = task_params
+        heapq.heappush(self._ready[queue_name], (self._seq_counter, task_id))
+        self._seq_counter += 1
+        self._id_counter += self._id_step
+
+        return task_id, ('ADD', queue_name, task_id, length, data)
+
+    def _get(self, queue_name, count):
+        time_now = datetime.datetime.now()
+        self._requeue_expired(queue_name, time_now)
+        queue = self._queues[queue_name]
+        ready = self._ready[queue_name]
+        taken = []
+        while ready and len(taken) < count:
+            seq, task_id = heapq.heappop(ready)
+            task_params = queue.get(task_id)
+            if task_params is None or task_params[2]:
+                continue
+
+            task_params[2] = True
+            task_params[3] = time_now
+            self._in_flight[queue_name][task_id] = seq
+            heapq.heappush(self._deadlines[queue_name], (time_now + self._timedelta, seq, task_id))
+            taken.append((task_id, task_params, ('GET', queue_name, task_id, time_now)))
+
+        return taken
+
+    def _ack(self, queue_name, task_id):
+        if task_id not in self._in_flight[queue_name]:
+            return None
+
+        self.check_timeout(queue_name, task_id)
+        if not self._queues[queue_name][task_id][2]:
+            return None
+
+        task_params = self._queues[queue_name].pop(task_id)
+        self._in_flight[queue_name].pop(task_id)
+        self._payloads.release(task_params[1])
+        return 'ACK', queue_name, task_id
 
     def in_command(self, queue_name, task_id):
+        self._warm(queue_name)
         if queue_name not in self._queues:
             raise ValueError("{} doesn't exist".format(queue_name))
         if task_id in self._queues[queue_name].keys():
-            status = "YES"
-        else:
-            status = "NO"
+            return "YES"
+        return "NO"
+
+    def check_timeout(self, queue_name, task_id):
+        task_params = self._queues[queue_name][task_id]
+        if task_params[2] and datetime.datetime.now() - task_params[3] > self._timedelta:
+            self._requeue(queue_name, task_id)
+
+    def _requeue_expired(self, queue_name, time_now):
+        # the heap may hold entries of tasks that were acked or taken again
+        # since then, they are recognized by a mismatching deadline
+        deadlines = self._deadlines[queue_name]
+        queue = self._queues[queue_name]
+        while deadlines and deadlines[0][0] <= time_now:
+            deadline, seq, task_id = heapq.heappop(deadlines)
+            task_params = queue.get(task_id)
+            if task_params is not None and task_params[2] and \
+                    task_params[3] + self._timedelta == deadline:
+                self._requeue(queue_name, task_id)
+
+    def _requeue(self, queue_name, task_id):
+        # a task that timed out goes back to its place in the order of adding
+        self.metrics.inc('timeout_requeues_total')
+        task_params = self._queues[queue_name][task_id]
+        task_params[2] = False
+        task_params[3] = None
+        seq = self._in_flight[queue_name].pop(task_id)
+        heapq.heappush(self._ready[queue_name], (seq, task_id))
+
+    def _add_queue(self, queue_name):
+        self._queues[queue_name] = OrderedDict()
+        self._ready[queue_name] = []
+        self._in_flight[queue_name] = dict()
+        self._deadlines[queue_name] = []
+
+    def _warm(self, queue_name):
+        if queue_name in self._cold:
+            self._load_queue(queue_name)
+            self._index_queue(queue_name)
+
+    def _load_queue(self, queue_name):
+        self._queues[queue_name] = self._snapshot.load_queue(self._cold.pop(queue_name))
+
+    def _index_queue(self, queue_name):
+        self._ready[queue_name] = []
+        self._in_flight[queue_name] = dict()
+        self._deadlines[queue_name] = []
+        for task_id, task_params in self._queues[queue_name].items():
+            # data of tasks loaded from the snapshot stays in the snapshot file
+            if not isinstance(task_params[1], Payload):
+                task_params[1] = self._payloads.put(task_params[1])
+            if task_params[2]:
+                self._in_flight[queue_name][task_id] = self._seq_counter
+                self._deadlines[queue_name].append(
+                    (task_params[3] + self._timedelta, self._seq_counter, task_id))
+            else:
+                self._ready[queue_name].append((self._seq_counter, task_id))
+            self._seq_counter += 1
+        heapq.heapify(self._deadlines[queue_name])
+
+    def _log(self, *records):
+        if not records:
+            return
+        if self.metrics.enabled:
+            started = self.metrics.clock()
+        try:
+            self._journal.append(*records)
+        except (IOError, OSError):
+            raise IOError(self._write_err_msg)
+        if self.metrics.enabled:
+            self.metrics.observe('journal_append', self.metrics.clock() - started)
+            self.metrics.inc('journal_records_total', len(records))
+
+        # a snapshot is written once the journal has grown to its size, so
+        # rewriting a large backlog costs O(1) per logged byte
+        if self._journal.records >= self._compact_every and \
+                self._journal.size >= self._snapshot.size:
+            if not self.save_changes_to_file():
+                raise IOError(self._write_err_msg)
+
+    def sync(self):
+        try:
+            self._journal.sync()
+        except (IOError, OSError):
+            raise IOError(self._write_err_msg)
 
-        if not self.save_changes_to_file():
+    async def wait_synced(self):
+        try:
+            await self._journal.wait_synced()
+        except (IOError, OSError):
             raise IOError(self._write_err_msg)
-        return status
 
-    def check_timeout(self, queue_name, task_id):
-        task_time_delta = datetime.datetime.now() - self._queues[queue_name][task_id][3]
-        if task_time_delta > self._timedelta:
-            self._queues[queue_name].pop(task_id)
+    def _apply(self, record):
+        # every record is idempotent, so replaying a journal on top of a
+        # snapshot that already contains part of it gives the same state
+        operation, queue_name, task_id = record[:3]
+        if queue_name in self._cold:
+            self._load_queue(queue_name)
+        queue = self._queues.setdefault(queue_name, OrderedDict())
+        if operation == 'ADD':
+            if task_id not in queue:
+                queue[task_id] = [record[3], record[4], False, None]
+            self._id_counter = max(self._id_counter, int(task_id) + self._id_step)
+        elif operation == 'GET':
+            if task_id in queue:
+                queue[task_id][2] = True
+                queue[task_id][3] = record[3]
+        elif operation == 'ACK':
+            queue.pop(task_id, None)
 
     def save_changes_to_file(self):
+        if self.metrics.enabled:
+            started = self.metrics.clock()
         try:
-            with shelve.open(self._filename, 'n') as log_file:
-                    for queue in self._queues:
-                        log_file[queue] = self._queues[queue]
-        except IOError:
+            self._cold = self._snapshot.write(self._id_counter, self._queues, self._cold)
+            self._journal.reset()
+            if self._payloads.needs_compaction():
+                self._payloads.compact(task_params[1] for queue in self._queues.values()
+                                       for task_params in queue.values()
+                                       if self._payloads.owns(task_params[1]))
+        except (IOError, OSError):
             return False
 
+        if self.metrics.enabled:
+            self.metrics.observe('save_changes_to_file', self.metrics.clock() - started)
         return True
 
+    def stats(self):
+        gauges = [('queues', len(self._queues) + len(self._cold)),
+                  ('queues_cold', len(self._cold)),
+                  ('recovery_seconds', self.recovery_time),
+                  ('journal_records', self._journal.records),
+                  ('journal_fsyncs', self._journal.fsyncs),
+                  ('payload_resident_bytes', self._payloads.resident),
+                  ('payload_spilled_bytes', self._payloads.spilled)]
+        sizes = [(queue_name, len(queue) - len(self._in_flight.get(queue_name, ())),
+                  len(self._in_flight.get(queue_name, ())))
+                 for queue_name, queue in self._queues.items()]
+        sizes.extend((queue_name, section[3], section[4])
+                     for queue_name, section in self._cold.items())
+        for queue_name, ready, in_flight in sorted(sizes):
+            gauges.append(('queue_ready{{queue="{}"}}'.format(queue_name), ready))
+            gauges.append(('queue_in_flight{{queue="{}"}}'.format(queue_name), in_flight))
+        return self.metrics.dump(gauges)
+
     def read_file(self):
+        started = time.perf_counter()
+        migrated = False
         try:
-            with shelve.open(self._filename, 'c') as log_file:
-                    for queue in log_file.keys():
-                        self._queues[queue] = log_file[queue]
-        except IOError:
+            if not os.path.exists(self._filename + '.snapshot') and \
+                    not os.path.exists(self._filename + '.journal'):
+                migrated = self._read_shelve()
+            state = self._snapshot.read()
+            if state is not None:
+                self._id_counter, queues, self._cold = state
+                self._queues.update(queues)
+            for record in self._journal.replay():
+                self._apply(record)
+        except (IOError, OSError):
             return False
-
+        finally:
+            for queue_name in self._queues:
+                self._index_queue(queue_name)
+            self.recovery_time = round(time.perf_counter() - started, 6)
+
+        # the imported queues go to a snapshot, so the shelve is read only once
+        return self.save_changes_to_file() if migrated else True
+
+    def _read_shelve(self):
+        # queues saved with shelve by the first version of the server,
+        # task data were kept as text
+        if not dbm.whichdb(self._filename):
+            return False
+        with shelve.open(self._filename, 'r') as log_file:
+            for queue_name in log_file.keys():
+                queue = OrderedDict()
+                for task_id, (length, data, running, time_get) in log_file[queue_name].items():
+                    if isinstance(data, str):
+                        data = data.encode('utf-8')
+                    queue[task_id] = [length, data, running, time_get]
+                    self._id_counter = max(self._id_counter, int(task_id) + self._id_step)
+                self._queues[queue_name] = queue
         return True
 
 
-def run(port=8080, timeout=5, ip_addr='0.0.0.0'):
-    max_command_length = 5000000
-    queues = Queues(timeout)
-    queues.read_file()
+def run(port=8080, timeout=5, ip_addr='0.0.0.0', mode='blocking', protocol='simple', shards=1,
+        metrics_file=None, **queue_options):
+    if int(shards) > 1:
+        from sharding import run_sharded
+        run_sharded(port, timeout, ip_addr, protocol, int(shards), metrics_file, queue_options)
+        return
+
+    queues = make_queues(timeout, **queue_options)
+    recover(queues)
+    if metrics_file is not None:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: write_stats(queues, metrics_file))
+    if mode == 'async':
+        asyncio.run(serve_async(queues, port, ip_addr, protocol))
+    else:
+        serve_blocking(queues, port, ip_addr)
+
+
+def make_queues(timeout, storage='memory', memory_budget=DEFAULT_MEMORY_BUDGET, metrics=None,
+                commit='sync', **kwargs):
+    if commit == 'group':
+        kwargs['group_commit'] = True
+    if storage == 'disk':
+        kwargs['memory_budget'] = int(memory_budget)
+    if metrics is not None:
+        kwargs['metrics'] = Metrics()
+    return Queues(timeout, **kwargs)
+
+
+def recover(queues, name='server'):
+    # serving an empty state would let the next compaction overwrite the data
+    if not queues.read_file():
+        sys.exit("{}: can't recover from the snapshot and the journal".format(name))
+    print('{}: recovered in {:.3f} s'.format(name, queues.recovery_time), flush=True)
+
+
+def write_stats(queues, filename):
+    with open(filename, 'w') as stats_file:
+        stats_file.write(queues.stats() + '\n')
+
+
+def serve_blocking(queues, port, ip_addr):
     connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     connection.bind((ip_addr, port))
     connection.listen(10)
     while True:
         current_connection, address = connection.accept()
-        command = current_connection.recv(max_command_length)
+        command = read_command(current_connection)
         response = command_processing(command, queues)
+        try:
+            queues.sync()
+        except IOError:
+            response = None
         send_and_close(current_connection, response)
 
 
+async def serve_async(queues, port, ip_addr, protocol='simple', path=None):
+    async def handle_connection(reader, writer):
+        command = await read_command_async(reader)
+        response = command_processing(command, queues)
+        try:
+            await queues.wait_synced()
+        except IOError:
+            response = None
+        if response is not None:
+            writer.writelines(response)
+        await close_writer(writer)
+
+    async def handle_frames(reader, writer):
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buffer += chunk
+                responses, consumed = frames_processing(buffer, queues)
+                del buffer[:consumed]
+                await queues.wait_synced()
+                writer.writelines(responses)
+                await writer.drain()
+        except (ValueError, IOError):
+            pass
+        await close_writer(writer)
+
+    handler = handle_frames if protocol == 'frames' else handle_connection
+    if path is not None:
+        server = await asyncio.start_unix_server(handler, path, backlog=1024)
+    else:
+        server = await asyncio.start_server(handler, ip_addr, port,
+                                            reuse_address=True, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+async def read_command_async(reader):
+    buffer = bytearray()
+    while True:
+        chunk = await reader.read(READ_CHUNK_SIZE)
+        buffer += chunk
+        length = command_length(buffer)
+        if not chunk or length is not None and len(buffer) >= length:
+            break
+        if length is not None:
+            try:
+                buffer += await reader.readexactly(length - len(buffer))
+            except asyncio.IncompleteReadError as error:
+                buffer += error.partial
+            break
+
+    if length is not None:
+        del buffer[length:]
+    return buffer
+
+
+async def close_writer(writer):
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+def read_command(current_connection):
+    # as soon as the length of the command is known the rest of it is
+    # received straight into a buffer of exactly that size
+    buffer = bytearray(READ_CHUNK_SIZE)
+    received = 0
+    while True:
+        nbytes = current_connection.recv_into(memoryview(buffer)[received:])
+        received += nbytes
+        length = command_length(memoryview(buffer)[:received])
+        if not nbytes or length is not None and received >= length:
+            break
+        if length is not None and length > len(buffer):
+            buffer.extend(bytes(length - len(buffer)))
+        elif received == len(buffer):
+            buffer.extend(bytes(len(buffer)))
+
+    del buffer[received if length is None else min(length, received):]
+    return buffer
+
+
+def split_frames(buffer):
+    # every frame is a 4-byte big-endian length followed by the command
+    frames = []
+    offset = 0
+    with memoryview(buffer) as view:
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > MAX_COMMAND_LENGTH:
+                raise ValueError("frame is too long: {}".format(length))
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            frames.append(bytes(view[offset + FRAME_HEADER.size:end]))
+            offset = end
+    return frames, offset
+
+
+def frames_processing(buffer, queues):
+    # answers are framed the same way and go in the order of the commands,
+    # an empty frame means that the command was rejected
+    frames, consumed = split_frames(buffer)
+    responses = []
+    for command in frames:
+        response = command_processing(command, queues) or []
+        responses.append(FRAME_HEADER.pack(sum(len(chunk) for chunk in response)))
+        responses.extend(response)
+    return responses, consumed
+
+
+def command_length(buffer):
+    # ADD and MADD are complete once <length> bytes of data follow every
+    # header, any other command ends where the client stopped sending
+    header = COMMAND_HEADER.match(buffer)
+    if header is None:
+        return None if INCOMPLETE_HEADER.match(buffer) else len(buffer)
+
+    if header.group(1) == b'ADD':
+        tasks_number, end = 1, header.start(3)
+    else:
+        tasks_number, end = int(header.group(3)), header.end()
+    for _ in range(tasks_number):
+        task_header = TASK_HEADER.match(buffer, end)
+        if task_header is None:
+            return None if INCOMPLETE_TASK_HEADER.match(buffer, end) else len(buffer)
+        end = task_header.end() + int(task_header.group(1))
+        if end > MAX_COMMAND_LENGTH:
+            return len(buffer)
+    return end
+
+
+def parse_command(command):
+    # only headers are decoded, task data stay slices of the received command
+    header = COMMAND_HEADER.match(command)
+    if header is None:
+        try:
+            params = str(command, 'utf-8').split()
+        except UnicodeDecodeError:
+            return None
+        # task data are taken only by the header and the length
+        if params and params[0] in ('ADD', 'MADD'):
+            return None
+        return params if check_command(params) else None
+
+    try:
+        params = [header.group(1).decode(), header.group(2).decode('utf-8')]
+    except UnicodeDecodeError:
+        return None
+    if header.group(1) == b'ADD':
+        tasks_number, end = 1, header.start(3)
+    else:
+        params.append(header.group(3).decode())
+        tasks_number, end = int(header.group(3)), header.end()
+
+    view = memoryview(command).toreadonly()
+    for _ in range(tasks_number):
+        task_header = TASK_HEADER.match(command, end)
+        if task_header is None:
+            return None
+        end = task_header.end() + int(task_header.group(1))
+        if end > len(command):
+            return None
+        params.append(task_header.group(1).decode())
+        params.append(view[task_header.end():end])
+    if not TRAILING_SPACES.match(command, end):
+        return None
+
+    return params if check_command(params) else None
+
+
 def command_processing(command, queues):
-    command = command.decode('utf-8')
-    if not check_command(command):
+    params = parse_command(command)
+    if params is None:
+        queues.metrics.inc('rejected_commands_total')
         return None
 
-    commands = {'ADD': queues.add_command, 'GET': queues.get_command,
-                'ACK': queues.ack_command, 'IN': queues.in_command}
-    parsed_command = command.split()
-    method_name = parsed_command[0]
-    params = parsed_command[1:]
-    response = commands[method_name](*params)
-    b_response = response.encode()
-    return b_response
+    metrics = queues.metrics
+    if metrics.enabled:
+        started = metrics.clock()
+    response = run_command(params[0], params[1:], queues)
+    if metrics.enabled:
+        metrics.observe('command_' + params[0].lower(), metrics.clock() - started)
+        if response is None:
+            metrics.inc('rejected_commands_total')
+    return response
+
+
+def run_command(method_name, params, queues):
+    commands = {'ADD': queues.add_command, 'ACK': queues.ack_command,
+                'IN': queues.in_command, 'MADD': queues.madd_command,
+                'MACK': queues.mack_command, 'STATS': queues.stats}
+    try:
+        if method_name == 'GET':
+            return task_chunks(queues.get_tasks(params[0], 1))
+        if method_name == 'MGET':
+            return task_chunks(queues.get_tasks(params[0], int(params[1])))
+        response = commands[method_name](*params)
+    except (ValueError, IOError):
+        return None
+    return [response.encode()]
 
 
-def check_command(command):
-    params = command.split()
+def task_chunks(tasks):
+    # task data go to the socket as they are stored, without joining
+    if not tasks:
+        return [b'NONE']
+    chunks = []
+    for task_id, length, data in tasks:
+        separator = ' ' if chunks else ''
+        chunks.append('{}{} {} '.format(separator, task_id, length).encode())
+        chunks.append(data)
+    return chunks
+
+
+def check_command(params):
     try:
-        if params[0] not in ['GET', 'ADD', 'ACK', 'IN']:
+        if params[0] not in ['GET', 'ADD', 'ACK', 'IN', 'MADD', 'MGET', 'MACK', 'STATS']:
+            return False
+        if params[0] == 'STATS' and len(params) != 1:
             return False
         if params[0] == 'GET' and len(params) != 2:
             return False
@@ -142,43 +647,90 @@ def check_command(command):
             return False
         if params[0] == 'ADD' and len(params) != 4:
             return False
+        if params[0] == 'MADD' and (int(params[2]) < 1 or len(params) != 3 + 2 * int(params[2])):
+            return False
+        if params[0] == 'MGET' and (len(params) != 3 or int(params[2]) < 1):
+            return False
+        if params[0] == 'MACK' and len(params) < 3:
+            return False
         return True
     except (ValueError, IndexError):
         return False
 
 
-def send_and_close(current_connection, data):
-    current_connection.send(data)
+def send_chunks(current_connection, chunks):
+    chunks = [memoryview(chunk) for chunk in chunks]
+    while chunks:
+        sent = current_connection.sendmsg(chunks[:MAX_SEND_CHUNKS])
+        while chunks and sent >= len(chunks[0]):
+            sent -= len(chunks[0])
+            chunks.pop(0)
+        if sent:
+            chunks[0] = chunks[0][sent:]
+
+
+def send_and_close(current_connection, chunks):
+    if chunks is not None:
+        send_chunks(current_connection, chunks)
     current_connection.shutdown(1)
     current_connection.close()
 
 
 def parse_args(_args):
+    options = dict()
+    positional = []
+    for arg in _args:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name.replace('-', '_')] = value
+        else:
+            positional.append(arg)
+
     try:
-        if not 0 <= int(_args[0]) <= 65535:
-            raise ValueError
-        _args[0] = int(_args[0])
+        if len(positional) > 0:
+            if not 0 <= int(positional[0]) <= 65535:
+                raise ValueError
+            positional[0] = int(positional[0])
 
-        if len(_args) > 1:
-            if not 1 <= int(_args[1]) <= 10000:
+        if len(positional) > 1:
+            if not 1 <= int(positional[1]) <= 10000:
                 raise ValueError
-            _args[1] = int(_args[1])
+            positional[1] = int(positional[1])
 
-        if len(_args) > 2:
-            ip_addr = _args[2].split('.')
+        if len(positional) > 2:
+            ip_addr = positional[2].split('.')
             if len(ip_addr) != 4 or not all([0 <= int(i) <= 255 for i in ip_addr]):
                 raise ValueError
 
-        return _args
+        if len(positional) > 3 or not set(options) <= set(OPTIONS):
+            raise ValueError
+        if options.get('mode', 'blocking') not in SERVER_MODES:
+            raise ValueError
+        if options.get('protocol', 'simple') not in PROTOCOLS:
+            raise ValueError
+        # a persistent connection would hold the only accept loop of the blocking server
+        if options.get('protocol') == 'frames' and options.get('mode') != 'async' and \
+                int(options.get('shards', 1)) == 1:
+            raise ValueError
+        if options.get('storage', 'memory') not in STORAGES:
+            raise ValueError
+        if int(options.get('memory_budget', 0)) < 0:
+            raise ValueError
+        if not 1 <= int(options.get('shards', 1)) <= 256:
+            raise ValueError
+        if options.get('commit', 'sync') not in COMMIT_MODES:
+            raise ValueError
+
+        return positional, options
     except ValueError:
-        print("Incorrect params\nUsage: python3 server.py [port] [timeout] [ip_address]")
+        print("Incorrect params\nUsage: python3 server.py [port] [timeout] [ip_address] "
+              "[--mode=blocking|async] [--protocol=simple|frames] "
+              "[--storage=memory|disk] [--memory-budget=BYTES] [--shards=N] "
+              "[--metrics] [--metrics-file=PATH] [--commit=sync|group]")
         return None
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        run()
-    else:
-        args = parse_args(sys.argv[1:])
-        if args:
-            run(*args)
+    args = parse_args(sys.argv[1:])
+    if args:
+        run(*args[0], **args[1])
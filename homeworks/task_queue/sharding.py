@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import zlib
+
+from server import FRAME_HEADER, READ_CHUNK_SIZE, close_writer, make_queues, \
+    read_command_async, recover, serve_async, split_frames, write_stats
+
+QUEUE_NAME = re.compile(rb'\s*\S+\s+(\S+)')
+STATS = re.compile(rb'\s*STATS\s*\Z')
+
+
+def run_sharded(port, timeout, ip_addr, protocol, shards, metrics_file, queue_options):
+    # every queue lives in exactly one worker process chosen by the hash of
+    # its name, so the number of shards must stay the same between restarts
+    paths = ['log.shard{}.sock'.format(index) for index in range(shards)]
+    workers = [multiprocessing.Process(target=run_worker, daemon=True,
+                                       args=(index, shards, paths[index], timeout,
+                                             metrics_file, queue_options))
+               for index in range(shards)]
+    for worker in workers:
+        worker.start()
+
+    def forward_signal(signum, frame):
+        for worker in workers:
+            os.kill(worker.pid, signum)
+
+    if metrics_file is not None:
+        signal.signal(signal.SIGUSR1, forward_signal)
+    try:
+        if not asyncio.run(watch_workers(workers, serve_router(port, ip_addr, protocol, paths))):
+            sys.exit("server: a shard didn't recover")
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+async def watch_workers(workers, router):
+    # the router stops if a shard exits with an error, e.g. it can't recover
+    router = asyncio.ensure_future(router)
+    while not router.done():
+        if any(worker.exitcode for worker in workers):
+            router.cancel()
+            return False
+        await asyncio.sleep(0.1)
+    await router
+    return True
+
+
+def run_worker(index, shards, path, timeout, metrics_file, queue_options):
+    queues = make_queues(timeout, filename='log.shard{}'.format(index),
+                         id_start=index, id_step=shards, **queue_options)
+    recover(queues, 'shard {}'.format(index))
+    if metrics_file is not None:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: write_stats(
+            queues, '{}.shard{}'.format(metrics_file, index)))
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        asyncio.run(serve_worker(queues, path, os.getppid()))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve_worker(queues, path, parent_pid):
+    # a worker doesn't outlive the router even if the router was killed
+    server = asyncio.ensure_future(serve_async(queues, None, None, 'frames', path))
+    while os.getppid() == parent_pid and not server.done():
+        await asyncio.sleep(1)
+    server.cancel()
+
+
+def shard_index(command, shards):
+    queue_name = QUEUE_NAME.match(command)
+    if queue_name is None:
+        return None
+    return zlib.crc32(queue_name.group(1)) % shards
+
+
+class Shard:
+    # one pipelined connection to a worker, answers come in request order
+    def __init__(self, path):
+        self._path = path
+        self._writer = None
+        self._pending = collections.deque()
+        self._connecting = asyncio.Lock()
+
+    async def request(self, command):
+        if self._writer is None:
+            async with self._connecting:
+                if self._writer is None:
+                    await self._connect()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.writelines([FRAME_HEADER.pack(len(command)), command])
+        return await future
+
+    async def _connect(self):
+        for _ in range(100):
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self._path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+        else:
+            raise ConnectionError("shard {} isn't available".format(self._path))
+        asyncio.ensure_future(self._read_responses(reader))
+
+    async def _read_responses(self, reader):
+        try:
+            while True:
+                length, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                response = await reader.readexactly(length)
+                self._pending.popleft().set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._writer = None
+            while self._pending:
+                self._pending.popleft().set_exception(ConnectionError(self._path))
+
+
+async def serve_router(port, ip_addr, protocol, paths):
+    shards = [Shard(path) for path in paths]
+
+    async def forward(command):
+        if STATS.match(command):
+            return await gather_stats(command)
+        index = shard_index(command, len(shards))
+        if index is None:
+            return b''
+        try:
+            return await shards[index].request(command)
+        except ConnectionError:
+            return b''
+
+    async def gather_stats(command):
+        responses = await asyncio.gather(*[shard.request(command) for shard in shards],
+                                         return_exceptions=True)
+        return b'\n'.join('# shard {}\n'.format(index).encode() + response
+                           for index, response in enumerate(responses)
+                           if isinstance(response, bytes))
+
+    async def handle_connection(reader, writer):
+        command = await read_command_async(reader)
+        response = await forward(bytes(command))
+        if response:
+            writer.write(response)
+        await close_writer(writer)
+
+    async def handle_frames(reader, writer):
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buffer += chunk
+                frames, consumed = split_frames(buffer)
+                del buffer[:consumed]
+                # requests are sent in order, so commands to one queue keep
+                # their order, and answers are awaited in the same order
+                requests = [asyncio.ensure_future(forward(command)) for command in frames]
+                for request in requests:
+                    response = await request
+                    writer.writelines([FRAME_HEADER.pack(len(response)), response])
+                await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        await close_writer(writer)
+
+    handler = handle_frames if protocol == 'frames' else handle_connection
+    server = await asyncio.start_server(handler, ip_addr, port,
+                                        reuse_address=True, backlog=1024)
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    async with server:
+        await stopped.wait()
@@ -0,0 +1,115 @@
+import os
+import pickle
+import struct
+from collections import OrderedDict
+
+from payloads import MappedFile, Payload
+
+# a snapshot is a section per queue followed by an index of the sections:
+#   section: task data one after another, pickled list of
+#            (task_id, length, running, time_get, data length)
+#   index:   pickled {'id_counter': ..., 'queues': {name: section entry}}
+#   trailer: index offset, index length, magic
+# a section entry is (offset, data length, tasks list length, ready, in flight),
+# so the server starts after reading only the index and loads a queue when
+# it is first used, task data is read from the mapped file when it is sent
+TRAILER = struct.Struct('>QQ4s')
+MAGIC = b'TQS1'
+
+
+class Snapshot:
+    def __init__(self, filename):
+        self._filename = filename
+        self._mapped = None
+        self.size = 0
+
+    def read(self):
+        # returns id counter, loaded queues and sections of queues not loaded yet
+        try:
+            self._mapped = MappedFile(self._filename)
+        except FileNotFoundError:
+            return None
+        self.size = self._mapped.size
+        if self._mapped.size < TRAILER.size:
+            raise IOError('broken snapshot ' + self._filename)
+        index_offset, index_length, magic = TRAILER.unpack(
+            self._mapped.view(self._mapped.size - TRAILER.size, TRAILER.size))
+        # a truncated or damaged file can fail to unpickle in many ways
+        try:
+            if magic != MAGIC:
+                # snapshot written by an older version: one pickle of everything
+                state = pickle.loads(self._mapped.view(0, self._mapped.size))
+                self._mapped = None
+                return state['id_counter'], state['queues'], dict()
+
+            index = pickle.loads(self._mapped.view(index_offset, index_length))
+            return index['id_counter'], dict(), index['queues']
+        except Exception as error:
+            raise IOError('broken snapshot ' + self._filename) from error
+
+    def load_queue(self, section):
+        offset, data_length, tasks_length = section[:3]
+        tasks = pickle.loads(self._mapped.view(offset + data_length, tasks_length))
+        queue = OrderedDict()
+        for task_id, length, running, time_get, size in tasks:
+            queue[task_id] = [length, Payload(self._mapped, offset, size), running, time_get]
+            offset += size
+        return queue
+
+    def write(self, id_counter, queues, sections):
+        # loaded queues are written out, sections of the others are copied
+        # as they are; returns the new sections of the queues not loaded
+        index = dict()
+        moved = []
+        tmp_filename = self._filename + '.tmp'
+        with open(tmp_filename, 'wb') as snapshot_file:
+            offset = 0
+            for queue_name, queue in queues.items():
+                tasks = []
+                in_flight = 0
+                data_length = 0
+                for task_id, (length, data, running, time_get) in queue.items():
+                    if isinstance(data, Payload):
+                        if data.store is self._mapped:
+                            moved.append((data, offset + data_length))
+                        data = data.store.read(data)
+                    snapshot_file.write(data)
+                    tasks.append((task_id, length, running, time_get, len(data)))
+                    data_length += len(data)
+                    in_flight += running
+                tasks_body = pickle.dumps(tasks, 5)
+                snapshot_file.write(tasks_body)
+                index[queue_name] = (offset, data_length, len(tasks_body),
+                                     len(tasks) - in_flight, in_flight)
+                offset += data_length + len(tasks_body)
+
+            for queue_name, section in sections.items():
+                section_length = section[1] + section[2]
+                snapshot_file.write(self._mapped.view(section[0], section_length))
+                index[queue_name] = (offset,) + tuple(section[1:])
+                offset += section_length
+
+            index_body = pickle.dumps({'id_counter': id_counter, 'queues': index}, 5)
+            snapshot_file.write(index_body)
+            snapshot_file.write(TRAILER.pack(offset, len(index_body), MAGIC))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(tmp_filename, self._filename)
+        _fsync_dir(os.path.dirname(os.path.abspath(self._filename)))
+
+        # data still referring to the replaced file is pointed to the new one,
+        # views of the old file that are being sent keep its mapping alive
+        self._mapped = MappedFile(self._filename)
+        self.size = self._mapped.size
+        for payload, offset in moved:
+            payload.store = self._mapped
+            payload.offset = offset
+        return {queue_name: index[queue_name] for queue_name in sections}
+
+
+def _fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,118 @@
+from unittest import TestCase, mock
+from server import Queues
+from journal import Journal
+import asyncio
+import os
+import tempfile
+
+
+class JournalTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._dir.name, 'log')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_replay(self):
+        journal = Journal(self._filename + '.journal')
+        journal.append(('ADD', 'q', '0', '1', 'a'))
+        journal.append(('GET', 'q', '0', None), ('ACK', 'q', '0'))
+        journal.close()
+
+        records = list(Journal(self._filename + '.journal').replay())
+        self.assertEqual(records, [('ADD', 'q', '0', '1', 'a'),
+                                   ('GET', 'q', '0', None), ('ACK', 'q', '0')])
+
+    def test_payload_buffers(self):
+        command = bytearray(b'ADD 1 3 a\x00c')
+        journal = Journal(self._filename + '.journal')
+        journal.append(('ADD', 'q', '0', '3', memoryview(command)[8:]))
+        journal.close()
+
+        records = list(Journal(self._filename + '.journal').replay())
+        self.assertEqual(records, [('ADD', 'q', '0', '3', b'a\x00c')])
+
+    def test_torn_tail(self):
+        journal = Journal(self._filename + '.journal')
+        journal.append(('ADD', 'q', '0', '1', 'a'), ('ADD', 'q', '1', '1', 'b'))
+        journal.close()
+        size = os.path.getsize(self._filename + '.journal')
+        with open(self._filename + '.journal', 'r+b') as journal_file:
+            journal_file.truncate(size - 3)
+
+        journal = Journal(self._filename + '.journal')
+        self.assertEqual(list(journal.replay()), [('ADD', 'q', '0', '1', 'a')])
+        self.assertEqual(journal.records, 1)
+        self.assertLess(os.path.getsize(self._filename + '.journal'), size - 3)
+
+    def test_group_commit(self):
+        journal = Journal(self._filename + '.journal', group_commit=True)
+        journal.append(('ADD', 'q', '0', '1', 'a'))
+        journal.append(('ADD', 'q', '1', '1', 'b'))
+        self.assertEqual(journal.fsyncs, 0)
+        journal.sync()
+        journal.sync()
+        self.assertEqual(journal.fsyncs, 1)
+        self.assertEqual(len(list(Journal(self._filename + '.journal').replay())), 2)
+
+    def test_wait_synced(self):
+        journal = Journal(self._filename + '.journal', group_commit=True)
+
+        async def client(task_id):
+            journal.append(('ADD', 'q', task_id, '1', 'a'))
+            await journal.wait_synced()
+
+        async def clients():
+            await asyncio.gather(*[client(str(task_id)) for task_id in range(10)])
+
+        asyncio.run(clients())
+        self.assertEqual(journal.fsyncs, 1)
+        journal.close()
+        self.assertEqual(len(list(Journal(self._filename + '.journal').replay())), 10)
+
+    def test_restart(self):
+        queues = Queues(5, self._filename)
+        first_id = queues.add_command('ABC', '1', b'a')
+        second_id = queues.add_command('ABC', '1', b'b')
+        queues.get_command('ABC')
+        queues.ack_command('ABC', first_id)
+
+        restored = Queues(5, self._filename)
+        restored.read_file()
+        self.assertEqual(list(restored._queues['ABC']), [second_id])
+        self.assertEqual(restored.add_command('ABC', '1', b'c'), '2')
+
+    def test_compaction(self):
+        queues = Queues(5, self._filename, compact_every=3)
+        for data in (b'a', b'b', b'c', b'd'):
+            queues.add_command('ABC', '1', data)
+        self.assertEqual(queues._journal.records, 1)
+        self.assertTrue(os.path.exists(self._filename + '.snapshot'))
+
+        restored = Queues(5, self._filename)
+        restored.read_file()
+        self.assertEqual([bytes(data) for task_id, length, data in restored.get_tasks('ABC', 4)],
+                         [b'a', b'b', b'c', b'd'])
+        self.assertEqual(restored._id_counter, 4)
+
+    def test_compaction_follows_snapshot_size(self):
+        # snapshots get rarer as the backlog grows, instead of one per 10 records
+        queues = Queues(5, self._filename, compact_every=10)
+        with mock.patch.object(queues, 'save_changes_to_file',
+                               wraps=queues.save_changes_to_file) as save:
+            for _ in range(2000):
+                queues.add_command('ABC', '100', b'x' * 100)
+        self.assertLess(save.call_count, 20)
+        self.assertLess(queues._journal.size, 2 * queues._snapshot.size)
+
+        restored = Queues(5, self._filename)
+        restored.read_file()
+        self.assertEqual(len(restored.get_tasks('ABC', 3000)), 2000)
+
+    def test_in_does_not_write(self):
+        queues = Queues(5, self._filename)
+        task_id = queues.add_command('ABC', '1', b'a')
+        size = os.path.getsize(self._filename + '.journal')
+        queues.in_command('ABC', task_id)
+        self.assertEqual(os.path.getsize(self._filename + '.journal'), size)
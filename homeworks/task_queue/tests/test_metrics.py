@@ -0,0 +1,48 @@
+from unittest import TestCase
+from server import Queues, command_processing
+from metrics import Histogram, Metrics
+import os
+import tempfile
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._dir.name, 'log')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for seconds in (0.0000005, 0.000003, 0.000003, 100):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.buckets[0], 1)
+        self.assertEqual(histogram.buckets[2], 2)
+        self.assertEqual(histogram.buckets[-1], 1)
+        self.assertEqual(histogram.count, 4)
+
+    def test_stats(self):
+        queues = Queues(0, self._filename, compact_every=2, metrics=Metrics())
+        command_processing(b'ADD q 1 a', queues)
+        command_processing(b'ADD q 1 b', queues)
+        command_processing(b'GET q', queues)
+        command_processing(b'GET q', queues)
+        command_processing(b'PUT q', queues)
+        stats = dict(line.rsplit(' ', 1) for line in
+                     b''.join(command_processing(b'STATS', queues)).decode().splitlines())
+
+        self.assertEqual(stats['queue_ready{queue="q"}'], '1')
+        self.assertEqual(stats['queue_in_flight{queue="q"}'], '1')
+        self.assertEqual(stats['timeout_requeues_total'], '1')
+        self.assertEqual(stats['rejected_commands_total'], '1')
+        self.assertEqual(stats['command_add_seconds_count'], '2')
+        self.assertEqual(stats['command_get_seconds_count'], '2')
+        self.assertEqual(stats['journal_append_seconds_count'], '4')
+        self.assertEqual(stats['save_changes_to_file_seconds_count'], '2')
+
+    def test_disabled(self):
+        queues = Queues(5, self._filename)
+        command_processing(b'ADD q 1 a', queues)
+        self.assertEqual(b''.join(command_processing(b'STATS', queues)).decode().splitlines()[-2:],
+                         ['queue_ready{queue="q"} 1', 'queue_in_flight{queue="q"} 0'])
@@ -0,0 +1,62 @@
+from unittest import TestCase
+from server import Queues
+from payloads import Payload, PayloadStore
+import os
+import tempfile
+
+
+class PayloadStoreTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._dir.name, 'log')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_memory_budget(self):
+        store = PayloadStore(self._filename + '.payloads', 4)
+        resident = store.put(b'abc')
+        spilled = store.put(b'defgh')
+        self.assertEqual(resident, b'abc')
+        self.assertIsInstance(spilled, Payload)
+        self.assertEqual((store.resident, store.spilled), (3, 5))
+        self.assertEqual(bytes(store.read(spilled)), b'defgh')
+
+        store.release(resident)
+        store.release(spilled)
+        self.assertEqual((store.resident, store.spilled), (0, 0))
+        self.assertFalse(os.path.exists(self._filename + '.payloads'))
+
+    def test_madd_slices_are_copied(self):
+        store = PayloadStore(self._filename + '.payloads')
+        command = bytearray(b'MADD ABC 2 1 a 1000 ' + b'b' * 1000)
+        small = store.put(memoryview(command)[13:14])
+        large = store.put(memoryview(command)[20:])
+        self.assertEqual(small, b'a')
+        self.assertIsInstance(small, bytes)
+        self.assertIsInstance(large, memoryview)
+        self.assertEqual(store.resident, 1001)
+
+    def test_compact(self):
+        store = PayloadStore(self._filename + '.payloads', 0)
+        payloads = [store.put(data) for data in (b'abc', b'de', b'fgh')]
+        store.release(payloads[0])
+        store.compact(payloads[1:])
+        self.assertEqual([payload.offset for payload in payloads[1:]], [0, 2])
+        self.assertEqual([bytes(store.read(payload)) for payload in payloads[1:]], [b'de', b'fgh'])
+        self.assertEqual(os.path.getsize(self._filename + '.payloads'), 5)
+
+    def test_spilled_queues(self):
+        queues = Queues(5, self._filename, compact_every=3, memory_budget=0)
+        first_id = queues.add_command('ABC', '3', b'abc')
+        queues.add_command('ABC', '2', b'de')
+        self.assertIsInstance(queues._queues['ABC'][first_id][1], Payload)
+        self.assertEqual([(task_id, length, bytes(data))
+                          for task_id, length, data in queues.get_tasks('ABC', 1)],
+                         [(first_id, '3', b'abc')])
+
+        restored = Queues(5, self._filename, memory_budget=0)
+        restored.read_file()
+        self.assertEqual([(task_id, length, bytes(data))
+                          for task_id, length, data in restored.get_tasks('ABC', 2)],
+                         [('1', '2', b'de')])
@@ -1,21 +1,44 @@
+import unittest
 from unittest import TestCase
-from server import Queues
+from server import Queues, command_length, parse_args, parse_command, split_frames
+from unittest import mock
 from collections import OrderedDict
+import asyncio
 import time
 import socket
+import struct
+import tempfile
 import subprocess
 import datetime
+import glob
+import os
+import shelve
+import shutil
+import signal
+
+
+def remove_log_files():
+    for filename in glob.glob('log.*'):
+        os.remove(filename)
+
+
+def start_server(server_args, workdir):
+    # the files of the server and its shards stay in workdir
+    return subprocess.Popen(server_args[:1] + [os.path.abspath(server_args[1])] + server_args[2:],
+                            cwd=workdir, stdout=subprocess.DEVNULL)
 
 
 class QueuesTest(TestCase):
     def setUp(self):
-        self.server = subprocess.Popen(['python3', 'server.py', '8080'])
+        remove_log_files()
+        self.server = subprocess.Popen(['python3', 'server.py', '8080'], stdout=subprocess.DEVNULL)
         time.sleep(0.5)
         self.queues = Queues(5)
 
     def tearDown(self):
         self.server.terminate()
         self.server.wait()
+        remove_log_files()
 
     def test_init(self):
         expected_results = (dict(), 'log', 0, datetime.timedelta(minutes=5))
@@ -24,50 +47,108 @@ class QueuesTest(TestCase):
         self.assertEqual(expected_results, real_results)
 
     def test_check_timeout(self):
-        test_time1 = datetime.datetime.now() - datetime.timedelta(minutes=4)
-        self.queues._queues[0] = OrderedDict()
-        self.queues._queues[0][0] = ['5', '12345', False, test_time1]
-        self.queues.check_timeout(0, 0)
-        self.assertEqual(len(self.queues._queues[0]), 1)
+        task_id = self.queues.add_command('ABC', '5', b'12345')
+        self.queues.get_command('ABC')
+        self.queues._queues['ABC'][task_id][3] = datetime.datetime.now() - datetime.timedelta(minutes=4)
+        self.queues.check_timeout('ABC', task_id)
+        self.assertTrue(self.queues._queues['ABC'][task_id][2])
+        self.assertEqual(self.queues.get_command('ABC'), None)
 
-        test_time2 = datetime.datetime.now() - datetime.timedelta(minutes=5)
-        self.queues._queues[0][0] = ['5', '12345', False, test_time2]
-        self.queues.check_timeout(0, 0)
-        self.assertEqual(len(self.queues._queues[0]), 0)
+        self.queues._queues['ABC'][task_id][3] = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        self.queues.check_timeout('ABC', task_id)
+        self.assertEqual(self.queues._queues['ABC'][task_id], ['5', b'12345', False, None])
+        self.assertEqual(self.queues.get_command('ABC'), (task_id + ' 5 ').encode() + b'12345')
+
+    def test_timeout_keeps_order(self):
+        ids = [self.queues.add_command('ABC', '1', data) for data in (b'a', b'b', b'c')]
+        self.assertEqual(self.queues.get_command('ABC'), (ids[0] + ' 1 ').encode() + b'a')
+        self.assertEqual(self.queues.get_command('ABC'), (ids[1] + ' 1 ').encode() + b'b')
+        for task_id in ids[:2]:
+            self.queues._queues['ABC'][task_id][3] -= datetime.timedelta(minutes=6)
+        self.assertEqual(self.queues.ack_command('ABC', ids[1]), 'NO')
+        self.queues.check_timeout('ABC', ids[0])
+        self.assertEqual(self.queues.get_command('ABC'), (ids[0] + ' 1 ').encode() + b'a')
+        self.assertEqual(self.queues.get_command('ABC'), (ids[1] + ' 1 ').encode() + b'b')
+        self.assertEqual(self.queues.get_command('ABC'), (ids[2] + ' 1 ').encode() + b'c')
+
+    def test_requeue_on_get(self):
+        queues = Queues(0)
+        task_id = queues.add_command('ABC', '1', b'a')
+        self.assertEqual(queues.get_command('ABC'), (task_id + ' 1 ').encode() + b'a')
+        self.assertEqual(queues.get_command('ABC'), (task_id + ' 1 ').encode() + b'a')
 
     def test_add_command(self):
-        id1 = self.queues.add_command('ABC', '6', '123456')
-        id2 = self.queues.add_command('BCD', '7', '1234567')
-        id3 = self.queues.add_command('ABC', '5', '12345')
+        id1 = self.queues.add_command('ABC', '6', b'123456')
+        id2 = self.queues.add_command('BCD', '7', b'1234567')
+        id3 = self.queues.add_command('ABC', '5', b'12345')
         q1 = self.queues._queues['ABC']
         q2 = self.queues._queues['BCD']
         ids = [id1, id2, id3]
         self.assertEqual(ids, ['0', '1', '2'])
-        self.assertEqual(q1, OrderedDict([('0', ['6', '123456', False, None]),
-                                          ('2', ['5', '12345', False, None])]))
-        self.assertEqual(q2, OrderedDict([('1', ['7', '1234567', False, None])]))
+        self.assertEqual(q1, OrderedDict([('0', ['6', b'123456', False, None]),
+                                          ('2', ['5', b'12345', False, None])]))
+        self.assertEqual(q2, OrderedDict([('1', ['7', b'1234567', False, None])]))
 
     def test_in_command(self):
-        task_id1 = self.queues.add_command('ABC', '6', '123456')
-        task_id2 = self.queues.add_command('ABCD', '4', '1234')
+        task_id1 = self.queues.add_command('ABC', '6', b'123456')
+        task_id2 = self.queues.add_command('ABCD', '4', b'1234')
         self.assertEqual(self.queues.in_command('ABC', task_id1), "YES")
         self.assertEqual(self.queues.in_command('ABCD', task_id1), "NO")
         self.assertEqual(self.queues.in_command('ABC', task_id2), "NO")
 
     def test_ack_command(self):
-        task_id = self.queues.add_command('ABC', '6', '123456')
+        task_id = self.queues.add_command('ABC', '6', b'123456')
         self.queues._queues['ABC'][task_id][3] = datetime.datetime.now()
         self.assertEqual(self.queues.ack_command('ABC', task_id), "NO")
 
+    def test_id_step(self):
+        queues = Queues(5, id_start=2, id_step=3)
+        self.assertEqual([queues.add_command('ABC', '1', b'a') for _ in range(3)], ['2', '5', '8'])
+
+    def test_batch_commands(self):
+        ids = self.queues.madd_command('ABC', '3', '1', b'a', '2', b'bb', '1', b'c').split()
+        self.assertEqual(ids, ['0', '1', '2'])
+        self.assertEqual(self.queues.mget_command('ABC', '2'), b'0 1 a 1 2 bb')
+        self.assertEqual(self.queues.mack_command('ABC', '0', '2', '1'), 'YES NO YES')
+        self.assertEqual(self.queues.mget_command('ABC', '5'), b'2 1 c')
+        self.assertEqual(self.queues.mget_command('ABC', '5'), None)
+
+    def test_batch_is_one_write(self):
+        with mock.patch('journal.os.fsync') as fsync:
+            self.queues.madd_command('ABC', '3', '1', b'a', '1', b'b', '1', b'c')
+            self.queues.mget_command('ABC', '3')
+            self.queues.mack_command('ABC', '0', '1', '2')
+        self.assertEqual(fsync.call_count, 3)
+        self.assertEqual(self.queues._journal.records, 9)
+
+    def test_group_commit_after_compaction(self):
+        # the journal is reset by a compaction before the scheduled fsync runs
+        queues = Queues(5, compact_every=2, group_commit=True)
+
+        async def add(data):
+            task_id = queues.add_command('ABC', '1', data)
+            await queues.wait_synced()
+            return task_id
+
+        async def run():
+            return await asyncio.gather(add(b'a'), add(b'b'), return_exceptions=True)
+
+        ids = asyncio.run(run())
+        self.assertEqual([queues.in_command('ABC', task_id) for task_id in ids], ['YES', 'YES'])
+
     def test_get_command(self):
-        task_id = self.queues.add_command('ABC', '6', '123456')
-        self.assertEqual(self.queues.get_command('ABC'), task_id + ' 6' + ' 123456')
+        task_id = self.queues.add_command('ABC', '6', b'123456')
+        self.assertEqual(self.queues.get_command('ABC'), (task_id + ' 6 ').encode() + b'123456')
         self.assertEqual(self.queues.get_command('ABC'), None)
 
 
 class ServerBaseTest(TestCase):
+    server_args = ['python3', 'server.py']
+
     def setUp(self):
-        self.server = subprocess.Popen(['python3', 'server.py'])
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.server = start_server(self.server_args, self.workdir)
         self._ip_addr = '127.0.0.1'
         self._port = 8080
         time.sleep(0.5)
@@ -116,13 +197,259 @@ class ServerBaseTest(TestCase):
 
         self.tearDown()
         time.sleep(0.5)
-        self.server = subprocess.Popen(['python3', 'server.py'])
+        self.server = start_server(self.server_args, self.workdir)
         time.sleep(0.5)
 
         self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
         self.assertEqual(b'NO', self.send(b'ACK 1 ' + task_id))
         self.assertEqual(b'NO', self.send(b'IN 1 ' + task_id))
 
+    def test_get_from_empty_queue(self):
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+
+    def test_batch_scenario(self):
+        ids = self.send(b'MADD 1 2 5 12345 3 abc').split()
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.send(b'MGET 1 5'), b' '.join([ids[0], b'5 12345', ids[1], b'3 abc']))
+        self.assertEqual(self.send(b'MACK 1 ' + b' '.join(ids)), b'YES YES')
+        self.assertEqual(self.send(b'MGET 1 5'), b'NONE')
+
+    def test_binary_data(self):
+        data = bytes(range(256)) * 4
+        task_id = self.send(b'ADD 1 1024 ' + data)
+        self.assertEqual(task_id + b' 1024 ' + data, self.send(b'GET 1'))
+
+    def test_malformed_add(self):
+        self.send(b' ADD q 5 hello')
+        self.send(b'ADD q x hello')
+        self.assertEqual(b'NONE', self.send(b'GET q'))
+
+    def test_partial_add(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 8080))
+        s.send(b'ADD 1 10 12345')
+        time.sleep(0.1)
+        s.send(b'67890')
+        task_id = s.recv(5000000)
+        s.close()
+        self.assertEqual(task_id + b' 10 1234567890', self.send(b'GET 1'))
+
+
+class AsyncServerTest(ServerBaseTest):
+    server_args = ['python3', 'server.py', '8080', '--mode=async']
+
+    def test_slow_producer(self):
+        slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow.connect(('127.0.0.1', 8080))
+        slow.send(b'ADD 1 10 12345')
+
+        task_id = self.send(b'ADD 2 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 2'))
+
+        slow.send(b'67890')
+        slow_task_id = slow.recv(5000000)
+        slow.close()
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + slow_task_id))
+
+
+class MetricsServerTest(ServerBaseTest):
+    server_args = ['python3', 'server.py', '8080', '--metrics', '--metrics-file=log.stats']
+
+    def test_stats(self):
+        self.send(b'ADD 1 5 12345')
+        self.assertIn(b'command_add_seconds_count 1', self.send(b'STATS'))
+
+        self.server.send_signal(signal.SIGUSR1)
+        time.sleep(0.2)
+        with open(os.path.join(self.workdir, 'log.stats')) as stats_file:
+            self.assertIn('queue_ready{queue="1"} 1', stats_file.read())
+
+
+class GroupCommitServerTest(AsyncServerTest):
+    server_args = ['python3', 'server.py', '8080', '--mode=async', '--commit=group']
+
+
+class DiskStorageServerTest(ServerBaseTest):
+    server_args = ['python3', 'server.py', '8080', '--storage=disk', '--memory-budget=0']
+
+
+class ShardedServerTest(ServerBaseTest):
+    server_args = ['python3', 'server.py', '8080', '--shards=3']
+
+    def test_stats(self):
+        self.send(b'ADD 1 5 12345')
+        stats = self.send(b'STATS').decode()
+        self.assertEqual(stats.count('# shard'), 3)
+        self.assertEqual(stats.count('queue_ready{queue="1"} 1'), 1)
+
+    def test_unique_ids(self):
+        ids = [self.send('ADD {} 1 a'.format(queue).encode()) for queue in 'abcdefgh']
+        self.assertEqual(len(set(ids)), len(ids))
+        for queue, task_id in zip('abcdefgh', ids):
+            self.assertEqual(task_id + b' 1 a', self.send('GET {}'.format(queue).encode()))
+
+
+class FramesServerTest(TestCase):
+    server_args = ['python3', 'server.py', '8080', '--mode=async', '--protocol=frames']
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.server = start_server(self.server_args, self.workdir)
+        time.sleep(0.5)
+        self.connection = socket.create_connection(('127.0.0.1', 8080))
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.terminate()
+        self.server.wait()
+
+    def send(self, *commands):
+        self.connection.sendall(b''.join(struct.pack('>I', len(command)) + command
+                                         for command in commands))
+        responses = []
+        for _ in commands:
+            length, = struct.unpack('>I', self.recv_exactly(4))
+            responses.append(self.recv_exactly(length))
+        return responses
+
+    def recv_exactly(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.connection.recv(length - len(data))
+            self.assertTrue(chunk)
+            data += chunk
+        return data
+
+    def test_pipelined_commands(self):
+        first_id, second_id, task = self.send(b'ADD 1 5 12345', b'ADD 1 3 abc', b'GET 1')
+        self.assertEqual(task, first_id + b' 5 12345')
+        self.assertEqual(self.send(b'ACK 1 ' + first_id, b'IN 1 ' + first_id, b'IN 1 ' + second_id),
+                         [b'YES', b'NO', b'YES'])
+
+    def test_rejected_command(self):
+        self.assertEqual(self.send(b'PUT 1', b'GET 1'), [b'', b'NONE'])
+
+    def test_two_connections(self):
+        # an idle persistent connection doesn't hold up another one
+        first = self.connection
+        self.connection = socket.create_connection(('127.0.0.1', 8080))
+        self.connection.settimeout(5)
+        try:
+            task_id, = self.send(b'ADD 1 5 12345')
+        finally:
+            self.connection.close()
+            self.connection = first
+        self.assertEqual(self.send(b'GET 1'), [task_id + b' 5 12345'])
+
+
+class ShardedFramesServerTest(FramesServerTest):
+    server_args = ['python3', 'server.py', '8080', '--protocol=frames', '--shards=2']
+
+
+class RecoveryTest(TestCase):
+    def setUp(self):
+        remove_log_files()
+
+    def tearDown(self):
+        remove_log_files()
+
+    def test_shelve_migration(self):
+        # the log of the first version: shelve of queues, ids from 0, data as text
+        timestamp = datetime.datetime.now()
+        with shelve.open('log', 'n') as log_file:
+            log_file['ABC'] = OrderedDict([('0', ['5', '12345', False, None]),
+                                           ('2', ['3', 'abc', True, timestamp])])
+            log_file['BCD'] = OrderedDict([('1', ['1', 'x', False, None])])
+
+        queues = Queues(5)
+        self.assertTrue(queues.read_file())
+        self.assertTrue(os.path.exists('log.snapshot'))
+        self.assertEqual(queues.get_tasks('ABC', 5), [('0', '5', b'12345')])
+        self.assertEqual(queues.in_command('ABC', '2'), 'YES')
+        self.assertEqual(queues.add_command('BCD', '1', b'y'), '3')
+        queues._journal.close()
+
+        # the shelve isn't imported again over the newer state
+        queues = Queues(5)
+        self.assertTrue(queues.read_file())
+        self.assertEqual(queues.mack_command('ABC', '0'), 'YES')
+        self.assertEqual(queues.get_tasks('BCD', 5), [('1', '1', b'x'), ('3', '1', b'y')])
+        queues._journal.close()
+
+    def test_truncated_snapshot(self):
+        queues = Queues(5, compact_every=2)
+        for _ in range(3):
+            queues.add_command('ABC', '5', b'12345')
+        queues._journal.close()
+        with open('log.snapshot', 'r+b') as snapshot_file:
+            snapshot_file.truncate(os.path.getsize('log.snapshot') // 2)
+        self.assertFalse(Queues(5).read_file())
+
+        for server_args in (['python3', 'server.py', '8080'],
+                            ['python3', 'server.py', '8080', '--shards=2']):
+            if server_args[-1] == '--shards=2':
+                os.rename('log.snapshot', 'log.shard0.snapshot')
+            snapshot_size = os.path.getsize(glob.glob('log*.snapshot')[0])
+            server = subprocess.run(server_args, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL, timeout=30)
+            self.assertNotEqual(server.returncode, 0)
+            self.assertEqual(os.path.getsize(glob.glob('log*.snapshot')[0]), snapshot_size)
+
+
+class CommandLengthTest(TestCase):
+    def test_command_length(self):
+        self.assertEqual(command_length(b'GET 1'), 5)
+        self.assertEqual(command_length(b'ADD 1 10 12345'), 14 + 5)
+        self.assertEqual(command_length(b'ADD 1 5 12345\n'), 13)
+        self.assertIsNone(command_length(b'ADD 1'))
+        self.assertEqual(command_length(b'ADD 1 x 12345'), 13)
+        self.assertEqual(command_length(b'MADD 1 2 5 12345 10 12345'), 30)
+        self.assertEqual(command_length(b'MADD 1 2 5 12345 '), None)
+        self.assertEqual(command_length(b'MADD 1 2 5 12345 3 abc'), 22)
+
+    def test_parse_command(self):
+        self.assertEqual(parse_command(b'MADD 1 2 5 12345 3 abc'),
+                         ['MADD', '1', '2', '5', b'12345', '3', b'abc'])
+        self.assertEqual(parse_command(b'ADD 1 5 1 3\x00\xff'), ['ADD', '1', '5', b'1 3\x00\xff'])
+        self.assertEqual(parse_command(b'ADD 1 5 12345\r\n'), ['ADD', '1', '5', b'12345'])
+        self.assertIsNone(parse_command(b'ADD 1 5 1234'))
+        self.assertIsNone(parse_command(b'ADD 1 3 12345'))
+        self.assertIsNone(parse_command(b'MADD 1 2 5 12345'))
+        self.assertIsNone(parse_command(b'MADD 1 0'))
+        self.assertEqual(parse_command(b'MGET 1 10'), ['MGET', '1', '10'])
+        self.assertIsNone(parse_command(b'MGET 1 x'))
+        self.assertEqual(parse_command(b'MACK 1 2 3'), ['MACK', '1', '2', '3'])
+        self.assertIsNone(parse_command(b'MACK 1'))
+        self.assertIsNone(parse_command(b'IN 1 \xff'))
+        self.assertIsNone(parse_command(b' ADD q 5 hello'))
+        self.assertIsNone(parse_command(b'ADD q x hello'))
+        self.assertIsNone(parse_command(b' MADD q 1 5 hello'))
+
+    def test_split_frames(self):
+        buffer = b'\x00\x00\x00\x05GET 1\x00\x00\x00\x07IN'
+        self.assertEqual(split_frames(buffer), ([b'GET 1'], 9))
+        with self.assertRaises(ValueError):
+            split_frames(b'\xff\xff\xff\xff')
+
+    def test_parse_args(self):
+        self.assertEqual(parse_args(['8081', '--mode=async']), ([8081], {'mode': 'async'}))
+        self.assertEqual(parse_args([]), ([], {}))
+        self.assertIsNone(parse_args(['8081', '--mode=threads']))
+        self.assertIsNone(parse_args(['8081', '--protocol=frames']))
+        self.assertEqual(parse_args(['--protocol=frames', '--shards=2']),
+                         ([], {'protocol': 'frames', 'shards': '2'}))
+
+
+class GroupCommitFramesServerTest(FramesServerTest):
+    server_args = ['python3', 'server.py', '8080', '--mode=async', '--protocol=frames',
+                   '--commit=group']
+
+    def test_one_fsync_per_batch(self):
+        self.send(*[b'ADD 1 1 a'] * 20)
+        stats = self.send(b'STATS')[0].split(b'\n')
+        self.assertIn(b'journal_fsyncs 1', stats)
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,73 @@
+from unittest import TestCase
+from server import Queues
+from journal import dumps
+import os
+import tempfile
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._dir.name, 'log')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def make_snapshot(self):
+        queues = Queues(5, self._filename)
+        queues.madd_command('ABC', '2', '3', b'abc', '2', b'de')
+        queues.madd_command('BCD', '1', '1', b'f')
+        queues.get_tasks('BCD', 1)
+        self.assertTrue(queues.save_changes_to_file())
+        return queues
+
+    def test_lazy_queues(self):
+        self.make_snapshot()
+        restored = Queues(5, self._filename)
+        self.assertTrue(restored.read_file())
+        self.assertEqual(restored._queues, {})
+        self.assertIn('queue_in_flight{queue="BCD"} 1', restored.stats().split('\n'))
+
+        self.assertEqual(restored.in_command('ABC', '0'), 'YES')
+        self.assertEqual(list(restored._cold), ['BCD'])
+        self.assertEqual([(task_id, length, bytes(data))
+                          for task_id, length, data in restored.get_tasks('ABC', 2)],
+                         [('0', '3', b'abc'), ('1', '2', b'de')])
+        self.assertEqual(restored.add_command('BCD', '1', b'g'), '3')
+
+    def test_journal_on_top_of_snapshot(self):
+        queues = self.make_snapshot()
+        queues.ack_command('BCD', '2')
+        queues.add_command('ABC', '1', b'g')
+
+        restored = Queues(5, self._filename)
+        restored.read_file()
+        self.assertEqual(list(restored._cold), [])
+        self.assertEqual(list(restored._queues['BCD']), [])
+        self.assertEqual([bytes(data) for task_id, length, data in restored.get_tasks('ABC', 5)],
+                         [b'abc', b'de', b'g'])
+
+    def test_rewrite_with_cold_queues(self):
+        self.make_snapshot()
+        restored = Queues(5, self._filename)
+        restored.read_file()
+        restored.get_tasks('ABC', 1)
+        self.assertTrue(restored.save_changes_to_file())
+        # the task taken before the rewrite still reads from the new file
+        self.assertEqual(bytes(restored._payloads.read(restored._queues['ABC']['1'][1])), b'de')
+
+        again = Queues(5, self._filename)
+        again.read_file()
+        self.assertEqual([bytes(data) for task_id, length, data in again.get_tasks('ABC', 5)],
+                         [b'de'])
+        self.assertEqual(again.in_command('BCD', '2'), 'YES')
+
+    def test_old_format(self):
+        with open(self._filename + '.snapshot', 'wb') as snapshot_file:
+            snapshot_file.write(dumps({'id_counter': 1,
+                                       'queues': {'ABC': {'0': ['1', b'a', False, None]}}}))
+        restored = Queues(5, self._filename)
+        self.assertTrue(restored.read_file())
+        self.assertEqual([(task_id, bytes(data)) for task_id, length, data
+                          in restored.get_tasks('ABC', 1)], [('0', b'a')])
+        self.assertEqual(restored.add_command('ABC', '1', b'b'), '1')